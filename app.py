@@ -10,6 +10,8 @@ import rollbar.contrib.flask
 
 import config
 
+from core import metrics
+
 app = Flask(__name__)
 app.config.from_object(config)
 
@@ -25,6 +27,15 @@ for blueprint in BLUEPRINTS:
     )
 
 
+@app.route('/metrics')
+def metrics_exposition():
+    return (
+        metrics.render(),
+        200,
+        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
 @app.before_first_request
 def init_rollbar():
     """init rollbar module"""
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+'''
+    Fires concurrent requests at the HTTP front end and reports how much
+    they overlapped. Without --url it starts benchmarks.slowapp, patched
+    (as run_app.py serves) and then --unpatched for comparison.
+
+    python -m benchmarks.concurrency [--requests 200] [--concurrency 50]
+        [--delay 0.2] [--pool-size 256] [--url http://127.0.0.1:8000 --path /edge/healthcheck]
+'''
+
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from benchmarks.throughput import percentile
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def start_slowapp(pool_size=None, unpatched=False):
+    port = free_port()
+    command = [sys.executable, '-m', 'benchmarks.slowapp', '--port', str(port)]
+
+    if pool_size:
+        command += ['--pool-size', str(pool_size)]
+
+    if unpatched:
+        command += ['--unpatched']
+
+    process = subprocess.Popen(command)
+    url = 'http://127.0.0.1:{}'.format(port)
+
+    for _ in xrange(100):
+        if process.poll() is not None:
+            break
+
+        try:
+            requests.get(url + '/slow/', params={'delay': 0}, timeout=1)
+
+            return process, url
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+    process.kill()
+
+    raise RuntimeError('benchmarks.slowapp did not start on {}'.format(url))
+
+
+def timed_request(session, url, params):
+    started_at = time.time()
+    response = session.get(url, params=params, timeout=120)
+    finished_at = time.time()
+
+    interval = (started_at, finished_at)
+
+    # The slow route reports when the server itself ran the request, which
+    # is what shows whether handlers overlapped.
+
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        body = response.json()
+
+        if 'started_at' in body:
+            interval = (body['started_at'], body['finished_at'])
+
+    return {
+        'status': response.status_code,
+        'latency': finished_at - started_at,
+        'interval': interval
+    }
+
+
+def peak_overlap(intervals):
+    events = sorted([(started_at, 1) for started_at, _ in intervals] + [(finished_at, -1) for _, finished_at in intervals])
+
+    peak = running = 0
+
+    for _, step in events:
+        running += step
+        peak = max(peak, running)
+
+    return peak
+
+
+def run(url, params, count, concurrency):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    workers = ThreadPool(concurrency)
+
+    started_at = time.time()
+    results = workers.map(lambda _: timed_request(session, url, params), xrange(count))
+    elapsed = time.time() - started_at
+
+    workers.close()
+    workers.join()
+
+    latencies = [result['latency'] for result in results]
+
+    return {
+        'elapsed': elapsed,
+        'rps': count / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'peak_overlap': peak_overlap([result['interval'] for result in results]),
+        'errors': len([result for result in results if result['status'] >= 500])
+    }
+
+
+def report(label, stats):
+    print '{0}: {1:.2f}s, {2:.1f} req/sec, p50 {3:.3f}s, p99 {4:.3f}s, peak overlap {5}, {6} errors'.format(
+        label,
+        stats['elapsed'],
+        stats['rps'],
+        stats['p50'],
+        stats['p99'],
+        stats['peak_overlap'],
+        stats['errors']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds the slow route blocks')
+    parser.add_argument('--pool-size', type=int, default=None)
+    parser.add_argument('--url', default=None, help='benchmark an already running server')
+    parser.add_argument('--path', default='/slow/')
+
+    args = parser.parse_args()
+
+    if args.url:
+        report(args.url, run(args.url.rstrip('/') + args.path, {'delay': args.delay}, args.requests, args.concurrency))
+
+        return
+
+    for label, unpatched in [('patched', False), ('unpatched', True)]:
+        process, url = start_slowapp(pool_size=args.pool_size, unpatched=unpatched)
+
+        try:
+            report(label, run(url + '/slow/', {'delay': args.delay}, args.requests, args.concurrency))
+        finally:
+            process.kill()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
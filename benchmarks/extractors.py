@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+'''
+    Compares the cart/checkout HTML extraction engines over the saved pages
+    in benchmarks/corpus.
+
+    python -m benchmarks.extractors [--repeat 50] [--engine fast]
+'''
+
+import io
+import os
+import time
+import argparse
+import resource
+import multiprocessing
+
+from core import extractors
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'corpus')
+
+
+def load_corpus():
+    corpus = []
+
+    for name in sorted(os.listdir(CORPUS_PATH)):
+        if not name.endswith('.html'):
+            continue
+
+        f = io.open(os.path.join(CORPUS_PATH, name), 'r', encoding='utf-8')
+        corpus.append((name, f.read()))
+        f.close()
+
+    return corpus
+
+
+def extract(extractor, name, html):
+    if name.startswith('externallink'):
+        return extractor.external_form(html)
+
+    return extractor.cart(html)
+
+
+def summarize(result):
+    if result is None:
+        return None
+
+    if hasattr(result, 'link'):
+        return (result.link,)
+
+    return (
+        result.count,
+        result.subtotal,
+        result.balance,
+        result.cart_status_message,
+        result.cart_checkout_button,
+        tuple(
+            (item.appid, item.packageid, item.title, item.price, item.remove_button)
+            for item in result.items or []
+        )
+    )
+
+
+def measure(engine, name, html, repeat, queue):
+    extractor = extractors.get_extractor(engine)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started_at = time.time()
+
+    for _ in xrange(repeat):
+        result = extract(extractor, name, html)
+
+    elapsed = time.time() - started_at
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    queue.put({
+        'ms_per_page': elapsed * 1000.0 / repeat,
+        'peak_kb': rss_after - rss_before,
+        'summary': summarize(result)
+    })
+
+
+def run(engine, name, html, repeat):
+    # Every measurement runs in its own process so peak RSS is not shared
+    # between engines or pages.
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(engine, name, html, repeat, queue))
+    process.start()
+
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--engine', action='append', choices=sorted(extractors.EXTRACTORS.keys()))
+
+    args = parser.parse_args()
+    engines = args.engine or sorted(extractors.EXTRACTORS.keys())
+
+    print '{0:<28} {1:<10} {2:>12} {3:>12} {4:>8}'.format('page', 'engine', 'ms/page', 'peak KB', 'match')
+
+    for name, html in load_corpus():
+        results = dict((engine, run(engine, name, html, args.repeat)) for engine in engines)
+        reference = results[engines[0]]['summary']
+
+        for engine in engines:
+            result = results[engine]
+
+            print '{0:<28} {1:<10} {2:>12.3f} {3:>12} {4:>8}'.format(
+                name,
+                engine,
+                result['ms_per_page'],
+                result['peak_kb'],
+                'yes' if result['summary'] == reference else 'NO'
+            )
+
+
+if __name__ == '__main__':
+    main()
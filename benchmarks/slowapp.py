@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+'''
+    Serves a route that blocks like a Redis or Steam round trip, with the
+    same server and patching as run_app.py. Started by
+    benchmarks.concurrency.
+
+    python -m benchmarks.slowapp [--port 8766] [--pool-size 256] [--unpatched]
+'''
+
+import sys
+
+# Same order as run_app.py: patch before anything else is imported.
+# --unpatched shows what serving looked like before.
+
+if '--unpatched' not in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
+import time
+import argparse
+
+from flask import Flask
+from flask import jsonify
+from flask import request
+
+from core import server
+
+
+def create_app():
+    app = Flask(__name__)
+
+    @app.route('/slow/')
+    def slow():
+        started_at = time.time()
+
+        time.sleep(float(request.args.get('delay', 0.2)))
+
+        return jsonify({
+            'started_at': started_at,
+            'finished_at': time.time()
+        })
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--pool-size', type=int, default=None)
+    parser.add_argument('--backlog', type=int, default=None)
+    parser.add_argument('--unpatched', action='store_true')
+
+    args = parser.parse_args()
+
+    http_server = server.build_server(
+        create_app(),
+        host=args.host,
+        port=args.port,
+        pool_size=args.pool_size,
+        backlog=args.backlog,
+        log=None
+    )
+    http_server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+'''
+    Local stand-in for the Steam store endpoints used by WebAccount, so the
+    purchase flow can be exercised without real accounts or money.
+
+    python -m benchmarks.standin [--port 8765] [--latency 50] [--error-rate 0.01]
+        [--reset-rate 0.01] [--purchase-limit 10] [--not-gifteable-every 97]
+'''
+
+import cgi
+import json
+import time
+import random
+import argparse
+import threading
+
+from flask import Flask
+from flask import request
+from flask import make_response
+
+from core import cart
+
+ACCOUNT_COOKIE = 'standinAccount'
+EXTERNAL_LINK = 'https://payments.example.com/pay/invoice?transid={}'
+
+CART_PAGE = u'''<!DOCTYPE html>
+<html lang="en">
+<head>
+	<meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+	<title>Shopping Cart</title>
+</head>
+<body class="v6 cart responsive_page">
+	<div id="global_header">
+		<a class="global_action_link" id="header_wallet_balance" href="/account/store_transactions/">{balance}</a>
+		<a class="store_header_btn_content" href="/cart/">Cart (<span id="cart_item_count_value">{count}</span>)</a>
+	</div>
+	<div class="page_content">
+		<div class="cart_status_message">{status_message}</div>
+		<div class="cart_area_body">
+			<div class="cart_item_list">
+{rows}
+			</div>
+			<div class="cart_total_row">
+				<div class="price" id="cart_price_total">{subtotal}</div>
+			</div>
+			<div class="checkout_content">
+{checkout_buttons}
+			</div>
+		</div>
+	</div>
+</body>
+</html>
+'''
+
+CART_ROW = u'''				<div class="cart_row" data-ds-appid="{appid}" data-ds-packageid="{packageid}">
+					<div class="cart_item_price ">
+						<div class="price">{price}</div>
+					</div>
+					<div class="cart_item_desc">
+						<a href="/app/{appid}/">{title}</a>
+						<a class="remove_link" href="javascript:removeLineItem( '{gid}' );">Remove</a>
+					</div>
+				</div>'''
+
+GIFT_BUTTON = u'				<a class="btnv6_green_white_innerfade continue" href="{}">Purchase as a gift</a>'.format(cart.GIFT_CHECKOUT_LINK)
+SELF_BUTTON = u'				<a class="btnv6_green_white_innerfade continue" href="/checkout/?purchasetype=self">Purchase for myself</a>'
+
+EXTERNAL_PAGE = u'''<!DOCTYPE html>
+<html>
+<body onload="document.getElementById('externalForm').submit();">
+	<form id="externalForm" name="externalForm" method="post" action="{}">
+		<input type="hidden" name="transid" value="{}">
+	</form>
+</body>
+</html>
+'''
+
+
+def format_price(cents):
+    return u'${0}.{1:02d}'.format(cents // 100, cents % 100)
+
+
+class StandInSettings(object):
+    def __init__(self, latency=0, jitter=0.5, error_rate=0, reset_rate=0, purchase_limit=0,
+                 not_gifteable_every=0, pending_polls=1, balance=1000000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.purchase_limit = purchase_limit
+        self.not_gifteable_every = not_gifteable_every
+        self.pending_polls = pending_polls
+        self.balance = balance
+
+
+class StandInStore(object):
+    '''
+        In-memory store state: one cart and one wallet per account, and
+        the transactions opened against them.
+
+        Package prices, titles and appids derive from the subid, so the
+        same subid always looks the same.
+    '''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+
+        self.accounts = {}
+        self.carts = {}
+        self.transactions = {}
+
+        self.next_id = 4000000000000000000
+
+    def new_id(self):
+        self.next_id += 1
+
+        return str(self.next_id)
+
+    def account(self, name):
+        return self.accounts.setdefault(name, {
+            'sessionid': '{0:024x}'.format(random.getrandbits(96)),
+            'balance': self.settings.balance,
+            'purchases': 0
+        })
+
+    def package(self, subid):
+        return {
+            'packageid': str(subid),
+            'appid': str(100000 + subid % 100000),
+            'title': u'Package {}'.format(subid),
+            'price': 99 + (subid % 50) * 100
+        }
+
+    def is_gifteable(self, subid):
+        every = self.settings.not_gifteable_every
+
+        return not every or subid % every != 0
+
+    def new_cart(self):
+        gid = self.new_id()
+        self.carts[gid] = []
+
+        return gid
+
+    def add(self, gid, subid):
+        if gid not in self.carts:
+            gid = self.new_cart()
+        elif random.random() < self.settings.reset_rate:
+            return self.new_cart(), False
+
+        line = dict(self.package(subid), gid=self.new_id())
+        self.carts[gid].append(line)
+
+        return gid, True
+
+    def remove(self, gid, lineitem_gid):
+        lines = self.carts.get(gid, [])
+
+        for line in lines:
+            if line['gid'] == lineitem_gid:
+                lines.remove(line)
+
+                return True
+
+        return False
+
+    def render_cart(self, account, gid, status_message=u''):
+        lines = self.carts.get(gid, [])
+        gifteable = all(self.is_gifteable(int(line['packageid'])) for line in lines)
+
+        return CART_PAGE.format(
+            balance=format_price(account['balance']),
+            count=len(lines),
+            status_message=status_message,
+            rows=u'\n'.join(
+                CART_ROW.format(
+                    appid=line['appid'],
+                    packageid=line['packageid'],
+                    price=format_price(line['price']),
+                    title=cgi.escape(line['title']),
+                    gid=line['gid']
+                )
+                # Newest line first, as on Steam
+                for line in reversed(lines)
+            ),
+            subtotal=format_price(sum(line['price'] for line in lines)),
+            checkout_buttons=u'\n'.join(([GIFT_BUTTON] if gifteable else []) + [SELF_BUTTON])
+        )
+
+
+def create_app(settings):
+    app = Flask(__name__)
+    store = StandInStore(settings)
+
+    app.config['STANDIN_STORE'] = store
+
+    def current_account():
+        return store.account(request.cookies.get(ACCOUNT_COOKIE) or 'anonymous')
+
+    def as_json(data):
+        return json.dumps(data), 200, {'Content-Type': 'application/json'}
+
+    @app.before_request
+    def simulate_network():
+        if settings.latency:
+            time.sleep(settings.latency / 1000.0 * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+        if settings.error_rate and random.random() < settings.error_rate:
+            return 'Internal Server Error', 500
+
+    @app.route('/standin/login/')
+    def standin_login():
+        name = request.args.get('account', 'anonymous')
+
+        with store.lock:
+            account = store.account(name)
+
+        response = make_response('OK')
+        response.set_cookie(ACCOUNT_COOKIE, name)
+        response.set_cookie('sessionid', account['sessionid'])
+
+        return response
+
+    @app.route('/')
+    def standin_home():
+        return u'<html><body>Welcome to the store stand-in</body></html>'
+
+    @app.route('/cart/', methods=['GET', 'POST'])
+    def standin_cart():
+        gid = request.cookies.get('shoppingCartGID')
+        status_message = u''
+
+        with store.lock:
+            account = current_account()
+
+            if request.method == 'POST':
+                if request.form.get('sessionid') != account['sessionid']:
+                    return 'Forbidden', 403
+
+                action = request.form.get('action')
+
+                if action == 'add_to_cart':
+                    gid, added = store.add(gid, int(request.form.get('subid')))
+
+                    if added:
+                        status_message = cart.ITEM_ADDED_MESSAGE
+                elif action == 'remove_line_item':
+                    if store.remove(gid, request.form.get('lineitem_gid')):
+                        status_message = cart.ITEM_REMOVED_MESSAGE
+
+            html = store.render_cart(account, gid, status_message)
+
+        response = make_response(html)
+
+        if gid and gid != request.cookies.get('shoppingCartGID'):
+            response.set_cookie('shoppingCartGID', gid)
+
+        return response
+
+    @app.route('/checkout/inittransaction/', methods=['POST'])
+    def standin_init_transaction():
+        gid = request.form.get('gidShoppingCart')
+
+        with store.lock:
+            account = current_account()
+
+            if gid not in store.carts or not len(store.carts[gid]):
+                return as_json({'success': 2, 'purchaseresultdetail': 0})
+
+            if settings.purchase_limit and account['purchases'] >= settings.purchase_limit:
+                return as_json({'success': 2, 'purchaseresultdetail': 53})
+
+            transid = store.new_id()
+            store.transactions[transid] = {
+                'gid': gid,
+                'total': sum(line['price'] for line in store.carts[gid]),
+                'payment_method': request.form.get('PaymentMethod'),
+                'polls': 0,
+                'finalized': False
+            }
+
+        return as_json({'success': 1, 'purchaseresultdetail': 0, 'transid': transid})
+
+    @app.route('/checkout/getfinalprice/')
+    def standin_get_final_price():
+        with store.lock:
+            account = current_account()
+            transaction = store.transactions.get(request.args.get('transid'))
+
+            if transaction is None:
+                return as_json({'success': 2})
+
+        return as_json({
+            'success': 1,
+            'total': transaction['total'],
+            'steamAccountBalance': account['balance']
+        })
+
+    @app.route('/checkout/finalizetransaction/', methods=['POST'])
+    def standin_finalize_transaction():
+        with store.lock:
+            account = current_account()
+            transaction = store.transactions.get(request.form.get('transid'))
+
+            if transaction is None:
+                return as_json({'success': 2})
+
+            if not transaction['finalized']:
+                transaction['finalized'] = True
+
+                account['balance'] -= transaction['total']
+                account['purchases'] += 1
+
+                store.carts.pop(transaction['gid'], None)
+
+        return as_json({'success': 22})
+
+    @app.route('/checkout/transactionstatus/')
+    def standin_transaction_status():
+        with store.lock:
+            transaction = store.transactions.get(request.args.get('transid'))
+
+            if transaction is None or not transaction['finalized']:
+                return as_json({'success': 2})
+
+            transaction['polls'] += 1
+
+            if transaction['polls'] <= settings.pending_polls:
+                return as_json({'success': 22})
+
+        return as_json({'success': 1})
+
+    @app.route('/checkout/externallink/')
+    def standin_external_link():
+        transid = request.args.get('transid')
+
+        if transid not in store.transactions:
+            return u'<html><body></body></html>'
+
+        return EXTERNAL_PAGE.format(cgi.escape(EXTERNAL_LINK.format(transid), quote=True), transid)
+
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0, help='mean latency per request in ms')
+    parser.add_argument('--jitter', type=float, default=0.5, help='latency spread, as a fraction of it')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with a 500')
+    parser.add_argument('--reset-rate', type=float, default=0, help='share of cart additions that reset the cart')
+    parser.add_argument('--purchase-limit', type=int, default=0, help='purchases per account before purchaseresultdetail 53')
+    parser.add_argument('--not-gifteable-every', type=int, default=0, help='subids divisible by this are not gifteable')
+    parser.add_argument('--pending-polls', type=int, default=1, help='transactionstatus polls answered as pending')
+
+
+def settings_from_args(args):
+    return StandInSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        reset_rate=args.reset_rate,
+        purchase_limit=args.purchase_limit,
+        not_gifteable_every=args.not_gifteable_every,
+        pending_polls=args.pending_polls
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    create_app(settings_from_args(args)).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+'''
+    Drives EdgeBot.add_subids_to_cart and EdgeBot.checkout_cart for many
+    orders against the store stand-in and reports orders/sec and latency
+    percentiles.
+
+    python -m benchmarks.throughput [--accounts 8] [--orders 200] [--items 3]
+        [--concurrency 8] [--batch] [--standin http://127.0.0.1:8765] [--verbose]
+        [stand-in options, see benchmarks.standin]
+'''
+
+import time
+import random
+import logging
+import argparse
+import threading
+
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+import requests
+
+from werkzeug.serving import make_server
+
+from core import bot
+from core import cart
+from core import enums
+from core import transport
+from benchmarks import standin
+
+
+class MemorySessionStore(object):
+    def exists(self):
+        return False
+
+    def is_stale(self):
+        return False
+
+    def load(self):
+        return None
+
+    def save(self, session):
+        return True
+
+
+class StandInAccount(bot.WebAccount):
+    '''
+        WebAccount logged into the stand-in instead of Steam.
+    '''
+
+    def __init__(self, network_id):
+        self.network_id = network_id
+        self.session_store = MemorySessionStore()
+
+        self.account_name = 'standin{}'.format(network_id)
+        self.password = None
+        self.shared_secret = None
+
+        self.use_2fa = False
+        self.is_valid = True
+
+        self.session = None
+        self.session_dirty = False
+        self.session_flushed_at = time.time()
+
+        self.cart = cart.CartMirror()
+
+        self.init_session()
+
+    def init_session(self):
+        session = transport.configure_session(requests.Session())
+        session.get(transport.store_url('/standin/login/'), params={'account': self.account_name})
+
+        session.cookies.set('steamLogin', '{}%7C%7Cstandin'.format(76561198000000000 + self.network_id), domain='steamcommunity.com')
+        session.cookies.set('steamCountry', 'US%7Cstandin', domain='steamcommunity.com')
+
+        self.session = session
+        self.save_session()
+        self.flush_session()
+
+        return True
+
+
+def start_standin(settings):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', 0, standin.create_app(settings), threaded=True)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def use_store(url):
+    transport.STORE_URL = url.rstrip('/')
+    transport.STORE_HOST = urlparse(url).hostname
+
+
+def percentile(values, fraction):
+    if not len(values):
+        return 0
+
+    values = sorted(values)
+
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def build_orders(count, items_per_order):
+    orders = []
+
+    for index in xrange(count):
+        orders.append({
+            'giftee_account_id': 10000000 + index,
+            'items': [
+                {
+                    'relation_type': 'A',
+                    'relation_id': index * items_per_order + position,
+                    'sub_id': random.randint(1000, 999999)
+                }
+                for position in xrange(items_per_order)
+            ]
+        })
+
+    return orders
+
+
+def checkout_outcome(result):
+    try:
+        if isinstance(result, dict):
+            return 'EResult.{}'.format(bot.EResult(result.get('result')).name)
+
+        return 'ETransactionResult.{}'.format(enums.ETransactionResult(result).name)
+    except ValueError:
+        return repr(result)
+
+
+def cart_mismatch(web_account, response):
+    '''
+        Compares the subids add_subids_to_cart reported with the cart the
+        stand-in holds. Read with the plain session, so it is neither timed
+        nor counted as a bot request.
+    '''
+
+    req = web_account.session.get(transport.store_url('/cart/'))
+    snapshot = cart.CartSnapshot.from_html(req.text)
+
+    reported = sorted(str(item.get('sub_id')) for item in response['items'])
+    held = sorted(line.packageid for line in snapshot.items)
+
+    return reported != held
+
+
+def run_order(edge_bot, lock, order, batch):
+    with lock:
+        started_at = time.time()
+        response = edge_bot.add_subids_to_cart(order['items'], batch=batch)
+        added_at = time.time()
+
+        mismatch = cart_mismatch(edge_bot.web_account, response)
+        checked_at = time.time()
+
+        if len(response['items']):
+            result = checkout_outcome(edge_bot.checkout_cart(order['giftee_account_id']))
+        else:
+            result = 'EmptyCart'
+
+        finished_at = time.time()
+
+    return {
+        'add': added_at - started_at,
+        'checkout': finished_at - checked_at,
+        'order': finished_at - started_at - (checked_at - added_at),
+        'items_added': len(response['items']),
+        'mismatch': mismatch,
+        'result': result
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--accounts', type=int, default=8)
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--items', type=int, default=3, help='subids per order')
+    parser.add_argument('--concurrency', type=int, default=None, help='defaults to the number of accounts')
+    parser.add_argument('--batch', action='store_true', help='add subids with CART_BATCH_ADD')
+    parser.add_argument('--standin', default=None, help='use an already running stand-in')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot logs')
+    standin.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        bot.log.setLevel(logging.ERROR)
+
+    use_store(args.standin or start_standin(standin.settings_from_args(args)))
+
+    edge_bots = [bot.EdgeBot(network_id, web_account=StandInAccount(network_id)) for network_id in xrange(1, args.accounts + 1)]
+    locks = [threading.Lock() for _ in edge_bots]
+
+    orders = build_orders(args.orders, args.items)
+    workers = ThreadPool(args.concurrency or args.accounts)
+
+    started_at = time.time()
+
+    pending = [
+        workers.apply_async(run_order, (edge_bots[index % len(edge_bots)], locks[index % len(edge_bots)], order, args.batch))
+        for index, order in enumerate(orders)
+    ]
+
+    results = [result.get() for result in pending]
+    elapsed = time.time() - started_at
+
+    workers.close()
+    workers.join()
+
+    print '{0} orders of {1} subids on {2} accounts in {3:.2f}s: {4:.2f} orders/sec'.format(
+        len(results),
+        args.items,
+        len(edge_bots),
+        elapsed,
+        len(results) / elapsed
+    )
+
+    print '{0:<10} {1:>10} {2:>10} {3:>10}'.format('phase', 'p50 ms', 'p99 ms', 'max ms')
+
+    for phase in ('add', 'checkout', 'order'):
+        durations = [result[phase] * 1000 for result in results]
+
+        print '{0:<10} {1:>10.1f} {2:>10.1f} {3:>10.1f}'.format(
+            phase,
+            percentile(durations, 0.5),
+            percentile(durations, 0.99),
+            max(durations)
+        )
+
+    print 'subids added: {0}/{1}'.format(sum(result['items_added'] for result in results), len(results) * args.items)
+    print 'carts not matching the reported subids: {}'.format(len([result for result in results if result['mismatch']]))
+
+    for outcome, count in Counter(result['result'] for result in results).most_common():
+        print '{0:<40} {1:>6}'.format(outcome, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,33 @@
 # -*- coding:Utf-8 -*-
 
 from flask import request
+from flask import Response
 from flask import Blueprint
+from flask import stream_with_context
 
 import json
 import time
+import config
+import threading
+import celery.states
 
 from core import enums
+from core import shared
+from core import accounts
+from core import scheduler
+from core import transactions
+from tasks import app
 from tasks import edge as edge_task
 from utils import route_decorators
 
 edge = Blueprint('edge.api', __name__)
 
+# Every /task/events/ stream holds a greenlet of the HTTP pool for up to
+# TASK_EVENTS_TIMEOUT seconds, the streams get their own smaller limit so
+# they cannot take the whole pool.
+
+TASK_EVENTS_STREAMS = threading.BoundedSemaphore(getattr(config, 'TASK_EVENTS_MAX_STREAMS', 64))
+
 
 @edge.route('/healthcheck')
 def edge_healthcheck():
@@ -27,6 +43,46 @@ def edge_healthcheck():
     return str(diff)
 
 
+@edge.route('/accounts/queues/')
+@route_decorators.as_json
+def edge_accounts_queues():
+    queues = {}
+
+    for network_id, depth in accounts.get_queue_depths().items():
+        queues[network_id] = {
+            'depth': depth,
+            'leased': accounts.is_leased(network_id)
+        }
+
+    return {
+        'success': True,
+        'queues': queues
+    }
+
+
+@edge.route('/accounts/schedule/')
+@route_decorators.as_json
+def edge_accounts_schedule():
+    subtotal = request.args.get('subtotal')
+
+    try:
+        subtotal = accounts.parse_price(subtotal) if subtotal else None
+    except ValueError:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.ParamNotSerializable.value
+        }
+
+    ranked = scheduler.rank_accounts(subtotal=subtotal)
+    idle = [network_id for network_id, state in ranked if not scheduler.is_busy(state)]
+
+    return {
+        'success': True,
+        'network_id': idle[0] if len(idle) else None,
+        'accounts': [dict(state, network_id=network_id, busy=scheduler.is_busy(state)) for network_id, state in ranked]
+    }
+
+
 @edge.route('/task/state/', methods=['POST'])
 @route_decorators.as_json
 def edge_cart_status():
@@ -56,13 +112,212 @@ def edge_cart_status():
     }
 
 
+@edge.route('/task/states/', methods=['POST'])
+@route_decorators.as_json
+def edge_task_states():
+    '''
+        tasks: [[task_name, task_id], ...]
+
+        States are read from the result backend at once. Results are only
+        returned for finished tasks and errors as their repr.
+    '''
+
+    tasks = request.form.get('tasks')
+
+    if not tasks:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.IncompleteForm.value
+        }
+
+    try:
+        tasks = json.loads(tasks)
+        task_ids = [task_id for task_name, task_id in tasks if hasattr(edge_task, task_name)]
+    except (ValueError, TypeError):
+        return {
+            'success': False,
+            'result': enums.EdgeResult.ParamNotSerializable.value
+        }
+
+    states = app.get_task_states(task_ids)
+    entries = {}
+
+    for task_name, task_id in tasks:
+        if task_id not in states:
+            entries[task_id] = {'result': enums.EdgeResult.TaskNotFound.value}
+
+            continue
+
+        entries[task_id] = app.task_entry(*states[task_id])
+
+    return {
+        'success': True,
+        'tasks': entries
+    }
+
+
+@edge.route('/task/events/')
+def edge_task_events():
+    '''
+        Server-Sent Events stream of the state changes of the given tasks
+        (?task_id=a&task_id=b), as published by the tasks themselves. The
+        current state of every task is sent first, the stream ends once all
+        of them are ready or after TASK_EVENTS_TIMEOUT seconds.
+
+        Answers 503 while TASK_EVENTS_MAX_STREAMS streams are open.
+    '''
+
+    task_ids = request.args.getlist('task_id')
+
+    if not len(task_ids):
+        return (
+            json.dumps({
+                'success': False,
+                'result': enums.EdgeResult.IncompleteForm.value
+            }),
+            200,
+            {'Content-Type': 'application/json'}
+        )
+
+    if not TASK_EVENTS_STREAMS.acquire(False):
+        return (
+            json.dumps({
+                'success': False,
+                'result': enums.EdgeResult.TooManyStreams.value
+            }),
+            503,
+            {'Content-Type': 'application/json', 'Retry-After': '5'}
+        )
+
+    response = Response(
+        stream_with_context(stream_task_events(task_ids)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+    # Called once the server is done with the stream, whether it ended or
+    # the client went away.
+
+    response.call_on_close(TASK_EVENTS_STREAMS.release)
+
+    return response
+
+
+def format_event(event, data):
+    return 'event: {0}\ndata: {1}\n\n'.format(event, data)
+
+
+def stream_task_events(task_ids):
+    pubsub = shared.get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*[app.task_events_channel(task_id) for task_id in task_ids])
+
+    pending = set(task_ids)
+
+    try:
+        # Subscribing before reading the current states means a task that
+        # finishes in between is seen at least once.
+
+        for task_id, (state, result) in app.get_task_states(task_ids).items():
+            entry = app.task_entry(state, result)
+            entry['task_id'] = task_id
+
+            if state in celery.states.READY_STATES:
+                pending.discard(task_id)
+
+            try:
+                yield format_event('state', json.dumps(entry))
+            except (TypeError, ValueError):
+                entry.pop('task_result', None)
+
+                yield format_event('state', json.dumps(entry))
+
+        deadline = time.time() + getattr(config, 'TASK_EVENTS_TIMEOUT', 300)
+        keepalive = getattr(config, 'TASK_EVENTS_KEEPALIVE', 15)
+        sent_at = time.time()
+
+        while len(pending) and time.time() < deadline:
+            message = pubsub.get_message(timeout=1)
+
+            if message is None:
+                if time.time() - sent_at > keepalive:
+                    sent_at = time.time()
+
+                    yield ': keepalive\n\n'
+
+                continue
+
+            entry = json.loads(message['data'])
+
+            if entry.get('task_status') in celery.states.READY_STATES:
+                pending.discard(entry.get('task_id'))
+
+            sent_at = time.time()
+
+            yield format_event('state', message['data'])
+
+        yield format_event('end', json.dumps({'pending': sorted(pending)}))
+    finally:
+        pubsub.close()
+
+
+def enqueue_order(task_name, network_id, args, kwargs=None, reserved=False):
+    '''
+        Enqueues an order task for network_id, or rejects it while the
+        account is cooling down or out of checkout attempts, unless `defer`
+        is set and the wait is within accounts.get_max_defer(). Releases
+        the scheduler reservation on the account once the task is queued or
+        the order is given up.
+    '''
+
+    try:
+        retry_after = accounts.admission_delay(network_id)
+
+        if retry_after and (not request.form.get('defer') or retry_after > accounts.get_max_defer()):
+            return {
+                'success': False,
+                'network_id': network_id,
+                'result': enums.EdgeResult.AccountCoolingDown.value,
+                'retry_after': retry_after
+            }
+
+        task = getattr(edge_task, task_name).apply_async(args, kwargs, countdown=retry_after or None)
+    finally:
+        if reserved:
+            accounts.release_reservation(network_id)
+
+    return {
+        'success': True,
+        'network_id': network_id,
+        'task_id': task.id,
+        'task_status': task.status,
+        'task_name': task_name,
+        'deferred_by': retry_after
+    }
+
+
 @edge.route('/cart/push/', methods=['POST'])
 @route_decorators.as_json
 def edge_cart_push():
+    '''
+        When network_id is left out, the account is picked by the scheduler
+        and returned with the task, an optional subtotal (in dollars) helps
+        it pick an account whose wallet covers the order. Answers
+        NoAccountAvailable when every account is busy with another order.
+
+        Orders for an account in a purchase limit cooldown or out of
+        checkout attempts are rejected with a retry_after, or queued to run
+        once it is over when `defer` is set and it is over within
+        MAX_DEFER_SECONDS.
+    '''
+
     items = request.form.get('items')
     network_id = request.form.get('network_id')
+    subtotal = request.form.get('subtotal')
 
-    if not items or not network_id:
+    if not items:
         return {
             'success': False,
             'result': enums.EdgeResult.IncompleteForm.value
@@ -76,22 +331,24 @@ def edge_cart_push():
             'result': enums.EdgeResult.ParamNotSerializable.value
         }
 
+    reserved = not network_id
+
     try:
-        network_id = int(network_id)
+        subtotal = accounts.parse_price(subtotal) if subtotal else None
+        network_id = int(network_id) if network_id else scheduler.reserve_account(subtotal=subtotal)
     except ValueError:
         return {
             'success': False,
             'result': enums.EdgeResult.ParamNotSerializable.value
         }
 
-    task = edge_task.add_subids_to_cart.delay(network_id, items)
+    if network_id is None:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.NoAccountAvailable.value
+        }
 
-    return {
-        'success': True,
-        'task_id': task.id,
-        'task_status': task.status,
-        'task_name': 'add_subids_to_cart'
-    }
+    return enqueue_order('add_subids_to_cart', network_id, (network_id, items), reserved=reserved)
 
 
 @edge.route('/cart/checkout/', methods=['POST'])
@@ -108,14 +365,55 @@ def edge_cart_checkout():
             'result': enums.EdgeResult.ParamNotSerializable.value
         }
 
-    task = edge_task.checkout_cart.delay(network_id, giftee_account_id)
+    return enqueue_order('checkout_cart', network_id, (network_id, giftee_account_id))
 
-    return {
-        'success': True,
-        'task_id': task.id,
-        'task_status': task.status,
-        'task_name': 'checkout_cart'
-    }
+
+@edge.route('/cart/purchase/', methods=['POST'])
+@route_decorators.as_json
+def edge_cart_purchase():
+    '''
+        Adds items to the cart and checks it out (getting the external link
+        for bitcoin payments) in a single task, see tasks.edge.purchase_order.
+        Takes the /cart/push/ parameters plus giftee_account_id and
+        `partial` to check out even if some items were not added.
+    '''
+
+    items = request.form.get('items')
+    network_id = request.form.get('network_id')
+    subtotal = request.form.get('subtotal')
+    giftee_account_id = request.form.get('giftee_account_id')
+
+    if not items or not giftee_account_id:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.IncompleteForm.value
+        }
+
+    reserved = not network_id
+
+    try:
+        items = json.loads(items)
+        subtotal = accounts.parse_price(subtotal) if subtotal else None
+        network_id = int(network_id) if network_id else scheduler.reserve_account(subtotal=subtotal)
+    except ValueError:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.ParamNotSerializable.value
+        }
+
+    if network_id is None:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.NoAccountAvailable.value
+        }
+
+    return enqueue_order(
+        'purchase_order',
+        network_id,
+        (network_id, items, giftee_account_id),
+        {'partial': bool(request.form.get('partial'))},
+        reserved=reserved
+    )
 
 
 @edge.route('/cart/reset/', methods=['POST'])
@@ -169,3 +467,28 @@ def edge_transaction_link():
         'task_status': task.status,
         'task_name': 'get_external_link_from_transid'
     }
+
+
+@edge.route('/transaction/status/', methods=['POST'])
+@route_decorators.as_json
+def edge_transaction_status():
+    transid = request.form.get('transid')
+
+    if not transid:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.IncompleteForm.value
+        }
+
+    status = transactions.get_transaction_status(transid)
+
+    if not status:
+        return {
+            'success': False,
+            'result': enums.EdgeResult.TransactionNotFound.value
+        }
+
+    return {
+        'success': True,
+        'transaction_status': status
+    }
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # -*- coding:Utf-8 -*-
 
+from functools import wraps
+
+from core import roster
+from core import shards
 from workers import WORKERS
 
 from flask import request
+from flask import Response
 from flask import jsonify
 from flask import redirect
 from flask import url_for
@@ -11,8 +16,82 @@ from flask import Blueprint
 
 isteamuser = Blueprint('isteamuser', __name__)
 
+FORWARDED_RESPONSE_HEADERS = ['Content-Type', 'ETag', 'X-Total-Count', 'Retry-After', 'Location']
+
+
+@isteamuser.before_request
+def route_to_shard():
+    '''
+        With several shards, requests for a network_id owned by another
+        shard are forwarded to it. Forwarded requests are always answered
+        locally, so shards that briefly disagree on ownership cannot loop.
+    '''
+
+    network_id = request.args.get('network_id', '')
+
+    if not network_id or not shards.is_sharded() or request.headers.get(shards.FORWARDED_HEADER):
+        return
+
+    shard_id, url = shards.ROUTER.owner(network_id)
+
+    if shard_id == shards.get_shard_id():
+        return
+
+    if url is None:
+        response = jsonify({'error': 'No shard is serving network_id {}'.format(network_id)})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+
+        return response
+
+    headers = dict((name, value) for name, value in request.headers.items() if name in ['If-None-Match'])
+
+    try:
+        forwarded = shards.ROUTER.forward(url, request.full_path, headers)
+    except Exception, e:
+        response = jsonify({'error': 'Shard {0} did not answer: {1}'.format(shard_id, e)})
+        response.status_code = 502
+
+        return response
+
+    return Response(
+        forwarded.content,
+        status=forwarded.status_code,
+        headers=dict(
+            (name, forwarded.headers[name]) for name in FORWARDED_RESPONSE_HEADERS if name in forwarded.headers
+        )
+    )
+
+
+def requires_ready_bot(f):
+    '''
+        Answers 503 while the SteamBot for the requested network_id is still
+        logging in (or failed to), instead of calling into its client.
+    '''
+
+    @wraps(f)
+    def requires_ready_bot_inner(*args, **kwargs):
+        network_id = request.args.get('network_id', '')
+        steambot = WORKERS.get(network_id)
+
+        if steambot is not None and not steambot.is_ready():
+            response = jsonify({
+                'error': 'SteamBot for network_id {} is not ready'.format(network_id),
+                'state': steambot.state,
+                'state_error': steambot.state_error
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+
+            return response
+
+        return f(*args, **kwargs)
+
+    return requires_ready_bot_inner
+
 
 @isteamuser.route('/SendMessage/')
+@requires_ready_bot
 def GetProductInfo():
     user = request.args.get('user', '')
     message = request.args.get('message', '')
@@ -27,6 +106,7 @@ def GetProductInfo():
 
 
 @isteamuser.route('/AddFriend/')
+@requires_ready_bot
 def AddFriend():
     steam_id = request.args.get('steam_id', '')
     network_id = request.args.get('network_id', '')
@@ -41,6 +121,7 @@ def AddFriend():
 
 
 @isteamuser.route('/GetFriendAddResults/')
+@requires_ready_bot
 def GetFriendAddResults():
     network_id = request.args.get('network_id', '')
 
@@ -49,53 +130,64 @@ def GetFriendAddResults():
 
     steambot = WORKERS[network_id]
 
-    return jsonify(steambot.friend_add_results)
-
+    return jsonify(dict(steambot.friend_add_results.items()))
 
-@isteamuser.route('/GetFriendsList/')
-def GetFriendsList():
-    network_id = request.args.get('network_id', '')
-    ids = request.args.get('ids', '')
 
-    if not network_id:
-        return jsonify({'error': 'No network_id provided'})
+@isteamuser.route('/GetReadiness/')
+def GetReadiness():
+    return jsonify(dict(
+        (network_id, {'state': steambot.state, 'state_error': steambot.state_error})
+        for network_id, steambot in WORKERS.items()
+    ))
 
-    result = []
-    friendslist = WORKERS[network_id].get_friends_list()
 
-    if ids:
-        return jsonify([x.steam_id.as_64 for x in friendslist])
+@isteamuser.route('/GetStateStats/')
+def GetStateStats():
+    network_id = request.args.get('network_id', '')
+    network_ids = [network_id] if network_id else WORKERS.keys()
 
-    for friend in friendslist:
-        result.append({
-            'SteamID64': friend.steam_id.as_64,
-            'avatar_url': friend.get_avatar_url(),
-            'name': friend.name
-        })
+    return jsonify(dict((network_id, WORKERS[network_id].get_state_stats()) for network_id in network_ids))
 
-    return jsonify(result)
 
+def roster_response(kind):
+    '''
+        Serves a precomputed roster view. Supports offset/limit paging
+        (total count in X-Total-Count) and If-None-Match against the ETag.
+    '''
 
-@isteamuser.route('/GetSentInvitations/')
-def GetSentInvitations():
     network_id = request.args.get('network_id', '')
     ids = request.args.get('ids', '')
 
     if not network_id:
         return jsonify({'error': 'No network_id provided'})
 
-    result = []
-    friendslist = WORKERS[network_id].get_sent_invitations()
+    try:
+        offset = int(request.args.get('offset') or 0)
+        limit = int(request.args.get('limit')) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'})
+
+    view = WORKERS[network_id].roster.view(kind, ids=bool(ids))
+    etag, body = view.page(offset, limit)
+
+    headers = {
+        'ETag': etag,
+        'X-Total-Count': str(len(view.items))
+    }
+
+    if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+        return Response(status=304, headers=headers)
+
+    return Response(body, mimetype='application/json', headers=headers)
 
-    if ids:
-        return jsonify([x.steam_id.as_64 for x in friendslist])
 
-    for friend in friendslist:
-        result.append({
-            'relationship': friend.relationship.value,
-            'SteamID64': friend.steam_id.as_64,
-            'avatar_url': friend.get_avatar_url(),
-            'name': friend.name
-        })
+@isteamuser.route('/GetFriendsList/')
+@requires_ready_bot
+def GetFriendsList():
+    return roster_response(roster.FRIENDS)
+
 
-    return jsonify(result)
+@isteamuser.route('/GetSentInvitations/')
+@requires_ready_bot
+def GetSentInvitations():
+    return roster_response(roster.INVITATIONS)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import re
+import math
+import time
+import uuid
+import threading
+
+import redis
+import config
+
+from core import shared
+
+RELEASE_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+
+return 0
+'''
+
+RENEW_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+
+return 0
+'''
+
+CHECKOUT_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens') or capacity)
+local updated_at = tonumber(redis.call('hget', KEYS[1], 'updated_at') or now)
+
+tokens = math.min(capacity, tokens + math.max(now - updated_at, 0) / interval)
+
+if tokens < 1 then
+    return tostring((1 - tokens) * interval)
+end
+
+if ARGV[4] == '1' then
+    redis.call('hmset', KEYS[1], 'tokens', tostring(tokens - 1), 'updated_at', tostring(now))
+    redis.call('expire', KEYS[1], math.ceil(capacity * interval))
+end
+
+return '0'
+'''
+
+QUEUES_KEY = shared.key('queues')
+
+
+class AccountLease(object):
+    '''
+        Short lived exclusive lease on a network_id, so cart and checkout
+        work for one Steam account never runs twice at the same time.
+    '''
+
+    def __init__(self, network_id, ttl=None):
+        self.key = shared.key('lease', network_id)
+        self.token = uuid.uuid4().hex
+        self.ttl = ttl or getattr(config, 'ACCOUNT_LEASE_TTL', 300)
+
+        self.released = threading.Event()
+
+    def acquire(self):
+        return bool(shared.get_redis().set(self.key, self.token, nx=True, ex=self.ttl))
+
+    def renew(self):
+        return bool(shared.get_redis().eval(RENEW_LEASE_SCRIPT, 1, self.key, self.token, self.ttl))
+
+    def keep_alive(self):
+        '''
+            Renews the lease every third of its ttl until it is released, so
+            a task that runs longer than the ttl (re-logins, checkout and
+            link polling) keeps the account. The ttl still frees the account
+            of a worker that died.
+        '''
+
+        thread = threading.Thread(target=self.renew_until_released)
+        thread.daemon = True
+        thread.start()
+
+    def renew_until_released(self):
+        while not self.released.wait(self.ttl / 3.0):
+            try:
+                if not self.renew():
+                    return
+            except redis.RedisError:
+                pass
+
+    def release(self):
+        self.released.set()
+
+        client = shared.get_redis()
+
+        return bool(client.eval(RELEASE_LEASE_SCRIPT, 1, self.key, self.token))
+
+
+def parse_network_ids(network_ids):
+    '''
+        Returns {network_id: int(network_id)} for the network_ids that are
+        numbers, leaving out the others.
+    '''
+
+    parsed = {}
+
+    for network_id in network_ids:
+        try:
+            parsed[network_id] = int(network_id)
+        except (TypeError, ValueError):
+            continue
+
+    return parsed
+
+
+def reserve(network_id):
+    '''
+        Short lived claim taken by the scheduler on the account it picks,
+        held until the order is enqueued and shows up in the queue depth, so
+        concurrent requests do not pick the same idle account.
+    '''
+
+    return bool(shared.get_redis().set(
+        shared.key('reserved', network_id),
+        time.time(),
+        nx=True,
+        ex=getattr(config, 'SCHEDULER_RESERVATION_TTL', 30)
+    ))
+
+
+def release_reservation(network_id):
+    try:
+        shared.get_redis().delete(shared.key('reserved', network_id))
+    except redis.RedisError:
+        pass
+
+
+def is_leased(network_id):
+    return bool(shared.get_redis().exists(shared.key('lease', network_id)))
+
+
+def start_cooldown(network_id, seconds=None):
+    '''
+        Keeps orders away from an account that hit the Steam purchase limit
+        (purchaseresultdetail 53) until the cooldown expires.
+    '''
+
+    seconds = seconds or getattr(config, 'PURCHASE_LIMIT_COOLDOWN', 3600)
+
+    try:
+        shared.get_redis().set(shared.key('cooldown', network_id), time.time() + seconds, ex=int(seconds))
+    except redis.RedisError:
+        pass
+
+
+def get_cooldown(network_id):
+    '''
+        Returns the seconds left in the cooldown of an account, 0 if none.
+    '''
+
+    return max(int(shared.get_redis().ttl(shared.key('cooldown', network_id)) or 0), 0)
+
+
+def checkout_retry_after(network_id, take=False):
+    '''
+        Token bucket on checkout attempts: CHECKOUT_BUCKET_SIZE attempts in
+        a burst, then one every CHECKOUT_BUCKET_INTERVAL seconds. Returns 0
+        when an attempt is allowed (taking a token if `take`), otherwise
+        the seconds until the next token.
+
+        Checkouts are not limited unless CHECKOUT_BUCKET_SIZE is set.
+    '''
+
+    capacity = getattr(config, 'CHECKOUT_BUCKET_SIZE', None)
+
+    if not capacity:
+        return 0
+
+    return float(shared.get_redis().eval(
+        CHECKOUT_BUCKET_SCRIPT,
+        1,
+        shared.key('checkout_bucket', network_id),
+        capacity,
+        getattr(config, 'CHECKOUT_BUCKET_INTERVAL', 600),
+        time.time(),
+        '1' if take else '0'
+    ))
+
+
+def admission_delay(network_id, take=False):
+    '''
+        Seconds an order for this account should wait before going through,
+        0 when it can go ahead now.
+    '''
+
+    cooldown = get_cooldown(network_id)
+
+    if cooldown:
+        return cooldown
+
+    return int(math.ceil(checkout_retry_after(network_id, take=take)))
+
+
+def get_max_defer():
+    '''
+        Longest countdown an order is deferred by. Kept well below the
+        visibility_timeout of the Redis broker (3600 seconds by default),
+        past which a task still waiting for its countdown is delivered
+        again and would run twice.
+    '''
+
+    return getattr(config, 'MAX_DEFER_SECONDS', 600)
+
+
+def queue_key(network_id):
+    return shared.key('queue', network_id)
+
+
+def add_queued_task(network_id, task_id, due_at=None):
+    '''
+        Counts task_id in the queue depth of network_id until it is removed.
+        The queue is a sorted set of task ids by the time they are due, so
+        adding a task again (a retry or a redelivery) only moves it, and
+        tasks older than QUEUE_DEPTH_MAX_AGE seconds, revoked or killed
+        before they could remove themselves, are pruned.
+    '''
+
+    pipe = shared.get_redis().pipeline()
+    pipe.zadd(queue_key(network_id), {task_id: due_at or time.time()})
+    pipe.sadd(QUEUES_KEY, network_id)
+    pipe.execute()
+
+
+def remove_queued_task(network_id, task_id):
+    shared.get_redis().zrem(queue_key(network_id), task_id)
+
+
+def count_queued_tasks(pipe, network_id):
+    '''
+        Queues pruning and counting the tasks of network_id on pipe, the
+        count is the second reply.
+    '''
+
+    pipe.zremrangebyscore(queue_key(network_id), '-inf', time.time() - getattr(config, 'QUEUE_DEPTH_MAX_AGE', 1800))
+    pipe.zcard(queue_key(network_id))
+
+
+def get_queue_depths():
+    client = shared.get_redis()
+    network_ids = list(client.smembers(QUEUES_KEY))
+
+    pipe = client.pipeline(transaction=False)
+
+    for network_id in network_ids:
+        count_queued_tasks(pipe, network_id)
+
+    replies = pipe.execute()
+
+    return dict((network_id, replies[index * 2 + 1]) for index, network_id in enumerate(network_ids))
+
+
+def parse_price(text):
+    '''
+        '$1,234.56' -> 123456 (cents), None when no amount is found.
+    '''
+
+    matches = re.findall(r'([0-9][0-9,]*(?:\.[0-9]{2})?)', text or '')
+
+    if not len(matches):
+        return None
+
+    return int(round(float(matches[0].replace(',', '')) * 100))
+
+
+def save_account_state(network_id, **state):
+    state['updated_at'] = time.time()
+
+    try:
+        shared.get_redis().hmset(shared.key('account', network_id), state)
+    except redis.RedisError:
+        pass
+
+
+def save_cart_state(network_id, snapshot):
+    state = {'cart_count': snapshot.count}
+
+    balance = parse_price(snapshot.balance)
+    subtotal = parse_price(snapshot.subtotal)
+
+    if balance is not None:
+        state['balance'] = balance
+
+    state['cart_subtotal'] = subtotal or 0
+
+    save_account_state(network_id, **state)
+
+
+def record_checkout(network_id, succeeded):
+    key = shared.key('account', network_id)
+
+    try:
+        pipe = shared.get_redis().pipeline()
+
+        if succeeded:
+            pipe.hset(key, 'failures', 0)
+        else:
+            pipe.hincrby(key, 'failures', 1)
+            pipe.hset(key, 'failed_at', time.time())
+
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def get_account_states(network_ids):
+    '''
+        Returns {network_id: state} with the cached state of every account,
+        its queue depth, whether it is leased or reserved by the scheduler
+        and the seconds left in its purchase limit cooldown, in a single
+        round trip.
+    '''
+
+    pipe = shared.get_redis().pipeline(transaction=False)
+
+    for network_id in network_ids:
+        pipe.hgetall(shared.key('account', network_id))
+        pipe.exists(shared.key('lease', network_id))
+        pipe.ttl(shared.key('cooldown', network_id))
+        pipe.exists(shared.key('reserved', network_id))
+        count_queued_tasks(pipe, network_id)
+
+    replies = pipe.execute()
+
+    states = {}
+
+    for index, network_id in enumerate(network_ids):
+        account_state, leased, cooldown, reserved, _, queue_depth = replies[index * 6:index * 6 + 6]
+
+        state = dict((field, float(value)) for field, value in account_state.items())
+
+        state['queue_depth'] = queue_depth
+        state['leased'] = bool(leased)
+        state['cooldown'] = max(int(cooldown or 0), 0)
+        state['reserved'] = bool(reserved)
+
+        states[network_id] = state
+
+    return states
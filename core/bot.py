@@ -5,14 +5,25 @@ import os
 import re
 import json
 import time
-import pickle
 import base64
 
+from enum import IntEnum
+from functools import wraps
+from collections import Counter
+
+import requests
 import config
 
-from core import items
+from core import cart
+from core import accounts
 from core import enums
 from core import logger
+from core import metrics
+from core import polling
+from core import sessions
+from core import transport
+from core import transactions
+from core import extractors
 
 import steam.guard
 import steam.webauth
@@ -21,10 +32,122 @@ from steam.enums import EResult
 log = logger.Logger('steamcommerce.purchases', 'steamcommerce.purchases.log').get_logger()
 
 
+class SessionExpired(Exception):
+    pass
+
+
+def relogin_on_logout(f):
+    '''
+        Runs a WebAccount call and, if Steam answers as if the session was
+        logged out, logs in again and retries the call once.
+    '''
+
+    @wraps(f)
+    def relogin_on_logout_inner(self, *args, **kwargs):
+        try:
+            return f(self, *args, **kwargs)
+        except SessionExpired, e:
+            log.info(u'Session for {0} is logged out ({1}), logging in again'.format(self.account_name, e))
+            metrics.incr('steam_session_expired_total', network_id=self.network_id)
+
+        shopping_cart_gid = self.get_shopping_cart_gid()
+
+        self.init_session()
+
+        # The new session has no shoppingCartGID, without it the retried call
+        # would work on a new cart and the items added so far would be lost
+        # without notice.
+
+        if shopping_cart_gid:
+            self.restore_shopping_cart_gid(shopping_cart_gid)
+
+        try:
+            return f(self, *args, **kwargs)
+        except SessionExpired, e:
+            log.error(u'Session for {0} is still logged out after login ({1})'.format(self.account_name, e))
+            self.invalidate()
+
+            return enums.EWebAccountResult.NotLoggedIn
+
+    return relogin_on_logout_inner
+
+
+def call_outcome(result):
+    if isinstance(result, IntEnum):
+        return result.name
+
+    if isinstance(result, requests.Response):
+        return 'Success' if result.status_code == 200 else 'HTTP{}'.format(result.status_code)
+
+    if result == '-1':
+        return enums.ETransactionResult.TooManyPurchases.name
+
+    return 'Success'
+
+
+def instrumented(endpoint):
+    '''
+        Records the duration of a WebAccount call to a Steam endpoint,
+        labelled by network_id and by the outcome the call returned.
+    '''
+
+    def instrumented_decorator(f):
+        @wraps(f)
+        def instrumented_inner(self, *args, **kwargs):
+            started_at = time.time()
+            outcome = 'Exception'
+
+            try:
+                result = f(self, *args, **kwargs)
+                outcome = call_outcome(result)
+
+                return result
+            finally:
+                metrics.observe(
+                    'steam_request_duration_seconds',
+                    time.time() - started_at,
+                    endpoint=endpoint,
+                    operation=f.__name__,
+                    network_id=self.network_id,
+                    result=outcome
+                )
+
+        return instrumented_inner
+
+    return instrumented_decorator
+
+
+def counted(f):
+    '''
+        Counts the results a WebAccount cart operation returns, labelled by
+        network_id, operation and result.
+    '''
+
+    @wraps(f)
+    def counted_inner(self, *args, **kwargs):
+        outcome = 'Exception'
+
+        try:
+            result = f(self, *args, **kwargs)
+            outcome = call_outcome(result)
+
+            return result
+        finally:
+            metrics.incr(
+                'steam_cart_results_total',
+                network_id=self.network_id,
+                operation=f.__name__,
+                result=outcome
+            )
+
+    return counted_inner
+
+
 class WebAccount(object):
     def __init__(self, network_id):
+        self.network_id = network_id
         self.data_path = os.path.join('data', '{}.json'.format(network_id))
-        self.pickle_path = os.path.join('data', '{}.pickle'.format(network_id))
+        self.session_store = sessions.get_session_store(network_id)
 
         data = self.get_data_from_file(self.data_path)
 
@@ -33,20 +156,23 @@ class WebAccount(object):
         self.shared_secret = data.get('shared_secret')
 
         self.use_2fa = False
+        self.is_valid = True
+
+        self.session = None
+        self.session_dirty = False
+        self.session_flushed_at = time.time()
+
+        self.cart = cart.CartMirror()
 
         if self.shared_secret:
             self.use_2fa = True
 
-        if os.path.exists(self.pickle_path):
-            self.init_session_from_file()
-        else:
-            self.init_session()
+        if self.session_store.exists():
+            self.init_session_from_store()
 
-        if not self.session_is_logged_in():
+        if self.session is None:
             self.init_session()
 
-        self.set_cart_count()
-
     def init_session(self):
         log.info(
             u'Initializing session for account_name {0}. USE 2FA: {1}'.format(
@@ -72,37 +198,93 @@ class WebAccount(object):
 
         log.info(u'Logged in, getting store sites for cookie setting')
 
-        session.get('http://store.steampowered.com')
-        session.get('https://store.steampowered.com')
+        transport.configure_session(session)
+        session.get(transport.store_url())
 
         self.session = session
-        self.save_session_to_file()
+        self.cart.invalidate()
+        self.save_session()
+        self.flush_session()
 
         log.info(u'Session for account name {} has been set'.format(self.account_name))
 
         return True
 
-    def save_session_to_file(self):
-        f = open(self.pickle_path, 'wb+')
-        pickle.dump(self.session, f)
-        f.close()
+    def save_session(self):
+        '''
+            Flags the session as changed. It is written to the session store
+            once the current task ends or when the flush interval is over.
+        '''
 
-    def init_session_from_file(self):
-        f = open(self.pickle_path, 'r')
-        session = pickle.load(f)
-        f.close()
+        self.session_dirty = True
 
-        self.session = session
+        if time.time() - self.session_flushed_at > getattr(config, 'SESSION_FLUSH_INTERVAL', 30):
+            self.flush_session()
 
-    def session_is_logged_in(self):
-        log.info(u'Checking if account is still logged for {}'.format(self.account_name))
+    def flush_session(self):
+        if not self.session_dirty:
+            return
 
-        req = self.session.get('https://store.steampowered.com')
+        saved = self.session_store.save(self.session)
 
-        if req.status_code != 200:
+        self.session_dirty = False
+        self.session_flushed_at = time.time()
+
+        if not saved:
+            log.info(u'Session for {} was changed by another worker, using that one'.format(self.account_name))
+
+            self.init_session_from_store()
+            self.invalidate()
+
+    def init_session_from_store(self):
+        self.session = self.session_store.load()
+        self.cart.invalidate()
+
+    def sync_session(self):
+        if self.session_dirty or not self.session_store.is_stale():
+            return
+
+        log.info(u'Reloading session for {} saved by another worker'.format(self.account_name))
+
+        self.init_session_from_store()
+
+        if self.session is None:
+            self.init_session()
+
+    def request(self, method, url, **kwargs):
+        req = self.session.request(method, url, **kwargs)
+
+        if self.response_is_logged_out(req):
+            raise SessionExpired(u'{0} {1} answered as logged out'.format(method, url))
+
+        return req
+
+    def response_is_logged_out(self, req):
+        if req.status_code in (401, 403):
+            return True
+
+        for response in req.history:
+            if '/login' in response.headers.get('Location', ''):
+                return True
+
+        if '/login' in req.url:
+            return True
+
+        if 'application/json' not in req.headers.get('Content-Type', ''):
+            return False
+
+        try:
+            data = req.json()
+        except ValueError:
             return False
 
-        return self.account_name in req.text
+        return isinstance(data, dict) and data.get('success') == EResult.NotLoggedOn
+
+    def invalidate(self):
+        log.info(u'Flagging web account {} as invalid'.format(self.account_name))
+
+        self.is_valid = False
+        self.cart.invalidate()
 
     def get_steam_id_from_cookies(self):
         return self.session.cookies.get('steamLogin', domain='steamcommunity.com').rsplit('%7C')[0]
@@ -123,160 +305,292 @@ class WebAccount(object):
 
         return json.loads(raw)
 
-    def get_cart_object(self, req=None):
+    @instrumented('cart')
+    def cart_request(self, method, **kwargs):
+        '''
+            The one place /cart is requested, so every cart round trip is
+            timed once, whether it is a GET or a POST.
+        '''
+
+        return self.request(method, transport.store_url('/cart/'), **kwargs)
+
+    @relogin_on_logout
+    def get_cart_snapshot(self, req=None):
         if not req:
-            req = self.session.get('https://store.steampowered.com/cart')
+            req = self.cart_request('GET')
 
         if req.status_code != 200:
+            self.invalidate()
+
             return enums.EWebAccountResult.Failed
 
-        cart_results = items.SteamCart.all_from(req.text)
+        snapshot = cart.CartSnapshot.from_html(req.text)
+
+        if snapshot is None:
+            self.invalidate()
 
-        if not len(cart_results):
             return enums.EWebAccountResult.CrawlerFailed
 
-        return cart_results[0]
+        return snapshot
 
-    def get_cart_count(self, req=None):
-        cart_object = self.get_cart_object(req=req)
+    def set_cart_count(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.get_cart_snapshot()
 
-        if isinstance(cart_object, enums.EWebAccountResult):
+        if isinstance(snapshot, enums.EWebAccountResult):
             log.error(u'Failed to retrieve current cart count')
 
-            return cart_object
+            return
+
+        self.cart.update(snapshot, self.get_shopping_cart_gid())
 
-        return len(cart_object.items or [])
+        accounts.save_cart_state(self.network_id, snapshot)
 
-    def set_cart_count(self, req=None):
-        cart_count = self.get_cart_count(req=req)
+    def get_cart(self):
+        '''
+            Returns the current CartSnapshot from the cart mirror, and only
+            downloads /cart when the mirror does not hold the cart the
+            shoppingCartGID cookie points to.
+        '''
 
-        if not isinstance(cart_count, enums.EWebAccountResult):
-            self.cart_count = cart_count
+        snapshot = self.cart.get(self.get_shopping_cart_gid())
 
-    def get_shopping_cart_gid(self):
-        return self.session.cookies.get('shoppingCartGID', domain='store.steampowered.com')
+        if snapshot is not None:
+            return snapshot
 
-    def reset_shopping_cart_gid(self):
-        return self.session.cookies.set('shoppingCartGID', None)
+        snapshot = self.get_cart_snapshot()
 
-    def get_session_id(self, domain):
-        return self.session.cookies.get('sessionid', domain=domain)
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return snapshot
 
-    def subid_was_added(self, req):
-        cart_object = self.get_cart_object(req=req)
+        self.set_cart_count(snapshot)
 
-        text_added = cart_object.cart_status_message == 'YOUR ITEM\'S BEEN ADDED!'
-        count_is_bigger = self.get_cart_count(req=req) > self.cart_count
+        return snapshot
 
-        return text_added and count_is_bigger
+    @property
+    def cart_count(self):
+        if self.cart.snapshot is None:
+            return 0
 
-    def gid_was_removed(self, req):
-        cart_object = self.get_cart_object(req=req)
+        return self.cart.snapshot.count
 
-        text_removed = cart_object.cart_status_message == 'YOUR ITEM HAS BEEN REMOVED!'
-        count_is_smaller = len(cart_object.items or []) < self.cart_count
+    def get_shopping_cart_gid(self):
+        return self.session.cookies.get('shoppingCartGID', domain=transport.STORE_HOST)
 
-        return text_removed and count_is_smaller
+    def restore_shopping_cart_gid(self, shopping_cart_gid):
+        self.session.cookies.set('shoppingCartGID', shopping_cart_gid, domain=transport.STORE_HOST)
+        self.save_session()
 
-    def cart_is_gifteable(self, req):
-        cart_object = self.get_cart_object(req=req)
-        checkout_link = 'https://store.steampowered.com/checkout/?purchasetype=gift'
+    def reset_shopping_cart_gid(self):
+        self.cart.empty()
 
-        return checkout_link in (cart_object.cart_checkout_button or '')
+        accounts.save_account_state(self.network_id, cart_count=0, cart_subtotal=0)
 
-    def add_subid_to_cart(self, subid):
-        shopping_cart_gid = self.get_shopping_cart_gid()
+        return self.session.cookies.set('shoppingCartGID', None)
+
+    def get_session_id(self, domain):
+        session_id = self.session.cookies.get('sessionid', domain=domain)
+
+        if not session_id:
+            raise SessionExpired(u'No sessionid cookie for {}'.format(domain))
+
+        return session_id
 
-        log.info(u'Adding subid {0} to cart {1}'.format(subid, shopping_cart_gid))
+    def subid_was_added(self, snapshot):
+        return snapshot.item_was_added() and snapshot.count > self.cart_count
+
+    def gid_was_removed(self, snapshot):
+        return snapshot.item_was_removed() and snapshot.count < self.cart_count
+
+    def cart_is_gifteable(self, snapshot):
+        return snapshot.is_gifteable()
+
+    def post_subid_to_cart(self, subid):
+        log.info(u'Adding subid {0} to cart {1}'.format(subid, self.get_shopping_cart_gid()))
 
         try:
-            req = self.session.post(
-                'http://store.steampowered.com/cart/',
+            req = self.cart_request(
+                'POST',
                 data={
-                    'sessionid': self.get_session_id('store.steampowered.com'),
+                    'sessionid': self.get_session_id(transport.STORE_HOST),
                     'action': 'add_to_cart',
                     'subid': str(subid)
                 }
             )
+        except SessionExpired:
+            raise
         except Exception, e:
             log.error(u'Failed to add subid {0} to cart. Raised {1}'.format(subid, e))
+            self.invalidate()
 
             return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
+            self.invalidate()
+
             return enums.EWebAccountResult.Failed
 
-        if not self.subid_was_added(req):
-            log.info(u'Checking if shoppingCartGID still exists')
+        return req
 
-            self.session.get('https://store.steampowered.com')
+    @counted
+    @relogin_on_logout
+    def add_subid_to_cart(self, subid):
+        shopping_cart_gid = self.get_shopping_cart_gid()
+
+        # The cart count before the POST tells an added item from a reset
+        # cart, it comes from the mirror unless the cart changed behind it.
+
+        previous_snapshot = self.get_cart()
+
+        if isinstance(previous_snapshot, enums.EWebAccountResult):
+            return previous_snapshot
+
+        req = self.post_subid_to_cart(subid)
+
+        if isinstance(req, enums.EWebAccountResult):
+            return req
+
+        snapshot = self.get_cart_snapshot(req=req)
+
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return snapshot
+
+        if not self.subid_was_added(snapshot):
+            # The cart POST answer already set shoppingCartGID if the cart
+            # was reset or dropped.
+
+            current_shopping_cart_gid = self.get_shopping_cart_gid()
 
-            self.set_cart_count(req=req)
-            self.save_session_to_file()
+            self.set_cart_count(snapshot)
+            self.save_session()
+
+            if not current_shopping_cart_gid:
+                self.invalidate()
 
-            if not self.get_shopping_cart_gid():
                 return enums.ECartResult.CartDissapeared
 
-            if self.get_shopping_cart_gid() != shopping_cart_gid:
+            if current_shopping_cart_gid != shopping_cart_gid:
+                self.invalidate()
+
                 return enums.ECartResult.CartReset
 
             return enums.ECartResult.Failed
 
-        self.set_cart_count(req=req)
-        self.save_session_to_file()
+        self.set_cart_count(snapshot)
+        self.save_session()
 
-        if not self.cart_is_gifteable(req):
+        if not self.cart_is_gifteable(snapshot):
             return enums.ECartResult.CartNotGifteable
 
         return enums.ECartResult.Added
 
+    @counted
+    def push_subids_to_cart(self, subids):
+        '''
+            Adds subids back to back, only looking for the gift button in
+            each response, and stops at the first subid that takes it away.
+            Returns how many subids were pushed and the CartSnapshot of the
+            last response.
+
+            A logout only retries the subid it was answered to, the subids
+            before it are in the cart already.
+        '''
+
+        req = None
+        pushed = 0
+
+        for subid in subids:
+            req = self.push_subid_to_cart(subid)
+
+            if isinstance(req, enums.EWebAccountResult):
+                return req
+
+            pushed += 1
+
+            if not cart.has_gift_button(req.text):
+                break
+
+        snapshot = self.get_cart_snapshot(req=req)
+
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return snapshot
+
+        self.set_cart_count(snapshot)
+        self.save_session()
+
+        return pushed, snapshot
+
+    @relogin_on_logout
+    def push_subid_to_cart(self, subid):
+        return self.post_subid_to_cart(subid)
+
+    @counted
+    @relogin_on_logout
     def remove_gid_from_cart(self, gid):
         shopping_cart_gid = self.get_shopping_cart_gid()
+        previous_snapshot = self.get_cart()
+
+        if isinstance(previous_snapshot, enums.EWebAccountResult):
+            return previous_snapshot
 
         log.info(u'Removing item gid {0} from cart {1}'.format(gid, shopping_cart_gid))
 
         try:
-            req = self.session.post(
-                'https://store.steampowered.com/cart/',
+            req = self.cart_request(
+                'POST',
                 data={
-                    'sessionid': self.get_session_id('store.steampowered.com'),
+                    'sessionid': self.get_session_id(transport.STORE_HOST),
                     'action': 'remove_line_item',
                     'cart': shopping_cart_gid,
                     'lineitem_gid': gid
                 }
             )
+        except SessionExpired:
+            raise
         except Exception, e:
             log.error(u'Failed to remove gif {0} from cart. Raised {1}'.format(gid, e))
+            self.invalidate()
 
             return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
+            self.invalidate()
+
             return enums.EWebAccountResult.Failed
 
-        if not self.gid_was_removed(req):
-            return enums.ECartResult.Failed
+        snapshot = self.get_cart_snapshot(req=req)
 
-        self.set_cart_count(req=req)
-        self.save_session_to_file()
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return snapshot
+
+        removed = self.gid_was_removed(snapshot)
+
+        self.set_cart_count(snapshot)
+        self.save_session()
+
+        if not removed:
+            return enums.ECartResult.Failed
 
         return enums.ECartResult.Removed
 
     def remove_last_cart_item(self):
-        cart_object = self.get_cart_object()
+        snapshot = self.get_cart()
+
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return snapshot
 
-        if not len(cart_object.items):
+        if not len(snapshot.items):
             return enums.ECartResult.Failed
 
-        last_item = cart_object.items[0]
-        remove_gid_matches = re.findall(r'([0-9]+)', last_item.remove_button, re.DOTALL)
+        remove_gid = snapshot.items[0].remove_gid
 
-        if not len(remove_gid_matches):
+        if not remove_gid:
             return enums.ECartResult.Failed
 
-        remove_gid = remove_gid_matches[0]
-
         return self.remove_gid_from_cart(remove_gid)
 
+    @relogin_on_logout
+    @instrumented('inittransaction')
     def init_transaction(self, giftee_account_id, payment_method='steamaccount'):
         country_code = self.get_country_code_from_cookies()
         shopping_cart_gid = self.get_shopping_cart_gid()
@@ -286,7 +600,7 @@ class WebAccount(object):
 
         log.info(u'Init transaction with shoppingCartGID {}'.format(shopping_cart_gid))
 
-        transaction_data = config.TRANSACTION_DATA
+        transaction_data = dict(config.TRANSACTION_DATA)
 
         transaction_data.update({
             'gidShoppingCart': shopping_cart_gid,
@@ -296,13 +610,22 @@ class WebAccount(object):
             'GifteeAccountID': giftee_account_id
         })
 
-        req = self.session.post(
-            'https://store.steampowered.com/checkout/inittransaction/',
-            data=transaction_data
-        )
+        try:
+            req = self.request(
+                'POST',
+                transport.store_url('/checkout/inittransaction/'),
+                data=transaction_data
+            )
+        except SessionExpired:
+            raise
+        except Exception, e:
+            log.error(u'Failed to init transaction for shoppingCartGID {0}. Raised {1}'.format(shopping_cart_gid, e))
+
+            return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
             log.error(u'Failed to init transaction. Status code {0} Body {1}'.format(req.status_code, req.text))
+            self.invalidate()
 
             return enums.EWebAccountResult.Failed
 
@@ -339,20 +662,30 @@ class WebAccount(object):
 
         return transid
 
+    @relogin_on_logout
+    @instrumented('getfinalprice')
     def get_transaction_final_price(self, transid, payment_method='steamaccount'):
         log.info(u'Getting final price for transid {}'.format(transid))
 
-        req = self.session.get(
-            'https://store.steampowered.com/checkout/getfinalprice/',
-            params={
-                'count': '1',
-                'transid': transid,
-                'purchasetype': 'gift',
-                'microtxnid': '-1',
-                'cart': self.get_shopping_cart_gid(),
-                'gidReplayOfTransID': '-1'
-            }
-        )
+        try:
+            req = self.request(
+                'GET',
+                transport.store_url('/checkout/getfinalprice/'),
+                params={
+                    'count': '1',
+                    'transid': transid,
+                    'purchasetype': 'gift',
+                    'microtxnid': '-1',
+                    'cart': self.get_shopping_cart_gid(),
+                    'gidReplayOfTransID': '-1'
+                }
+            )
+        except SessionExpired:
+            raise
+        except Exception, e:
+            log.error(u'Failed to get transaction price for transid {0}. Raised {1}'.format(transid, e))
+
+            return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
             log.error(u'Failed to get transaction price. Status code {0} Body {1}'.format(req.status_code, req.text))
@@ -390,16 +723,34 @@ class WebAccount(object):
 
         return enums.ETransactionResult.Success
 
+    @instrumented('finalizetransaction')
     def finalize_transaction(self, transid):
+        '''
+            Not retried after logging in again: the POST charges the wallet
+            and may have gone through before the logout was noticed, the
+            transaction status tells whether it did.
+        '''
+
         log.info(u'Finalizing transaction for transid {}'.format(transid))
 
-        req = self.session.post(
-            'https://store.steampowered.com/checkout/finalizetransaction/',
-            data={
-                'transid': transid,
-                'CardCVV2': ''
-            }
-        )
+        try:
+            req = self.request(
+                'POST',
+                transport.store_url('/checkout/finalizetransaction/'),
+                data={
+                    'transid': transid,
+                    'CardCVV2': ''
+                }
+            )
+        except SessionExpired, e:
+            log.error(u'Session for {0} is logged out, transid {1} may not be finalized ({2})'.format(self.account_name, transid, e))
+            self.invalidate()
+
+            return enums.EWebAccountResult.NotLoggedIn
+        except Exception, e:
+            log.error(u'Failed to finalize transaction for transid {0}. Raised {1}'.format(transid, e))
+
+            return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
             log.error(u'Failed to finalize transaction. Status code {0} Body {1}'.format(req.status_code, req.text))
@@ -419,16 +770,43 @@ class WebAccount(object):
 
         return data
 
+    @relogin_on_logout
     def get_transaction_status(self, transid):
+        return self.fetch_transaction_status(transid)
+
+    def read_transaction_status(self, transid):
+        '''
+            Like get_transaction_status but answers NotLoggedIn instead of
+            logging in again, for callers that do not hold the account lease
+            and would replace the session of the task holding it.
+        '''
+
+        try:
+            return self.fetch_transaction_status(transid)
+        except SessionExpired, e:
+            log.info(u'Session for {0} is logged out, not reading transid {1} ({2})'.format(self.account_name, transid, e))
+
+            return enums.EWebAccountResult.NotLoggedIn
+
+    @instrumented('transactionstatus')
+    def fetch_transaction_status(self, transid):
         log.info(u'Getting transaction status for transid {}'.format(transid))
 
-        req = self.session.get(
-            'https://store.steampowered.com/checkout/transactionstatus/',
-            params={
-                'count': '1',
-                'transid': transid
-            }
-        )
+        try:
+            req = self.request(
+                'GET',
+                transport.store_url('/checkout/transactionstatus/'),
+                params={
+                    'count': '1',
+                    'transid': transid
+                }
+            )
+        except SessionExpired:
+            raise
+        except Exception, e:
+            log.error(u'Failed to get transaction status for transid {0}. Raised {1}'.format(transid, e))
+
+            return enums.EWebAccountResult.UnknownException
 
         if req.status_code != 200:
             log.error(u'Failed to get transaction status. Status code {0} Body {1}'.format(req.status_code, req.text))
@@ -448,65 +826,89 @@ class WebAccount(object):
 
         return data
 
-    def get_external_link_from_transid(self, transid):
-        attemps = 10
-        external_link = None
-
-        while external_link is None and attemps > 0:
-            log.info(u'Getting external link for transid {0} ({1}/10) '.format(transid, attemps))
-
-            req = self.session.get(
-                'https://store.steampowered.com/checkout/externallink/',
+    @relogin_on_logout
+    @instrumented('externallink')
+    def get_external_link(self, transid):
+        try:
+            req = self.request(
+                'GET',
+                transport.store_url('/checkout/externallink/'),
                 params={
                     'transid': transid
                 }
             )
+        except SessionExpired:
+            raise
+        except Exception, e:
+            log.error(u'Failed to get external link for transid {0}. Raised {1}'.format(transid, e))
 
-            if req.status_code != 200:
-                log.error(u'Failed to get external link. Status code {0} Body {1}'.format(req.status_code, req.text))
+            return enums.EWebAccountResult.UnknownException
 
-                return enums.EWebAccountResult.Failed.value
+        if req.status_code != 200:
+            log.error(u'Failed to get external link. Status code {0} Body {1}'.format(req.status_code, req.text))
 
-            forms = items.ExternalForm.all_from(req.text)
+            return enums.EWebAccountResult.Failed
 
-            if not len(forms):
-                log.error(u'Could not match any ExternalFrom from body')
+        form = extractors.get_extractor().external_form(req.text)
 
-                return enums.EWebAccountResult.Failed.value
+        if form is None:
+            log.error(u'Could not match any ExternalFrom from body')
 
-            log.debug(req.text)
+            return enums.EWebAccountResult.Failed
 
-            external_link = forms[0].link
+        log.debug(req.text)
 
-            if not external_link:
-                attemps -= 1
+        return form.link
 
-                continue
+    def get_external_link_from_transid(self, transid, deadline=30):
+        def poll():
+            try:
+                external_link = self.get_external_link(transid)
+            except requests.RequestException, e:
+                log.error(u'Failed to get external link for transid {0}. Raised {1}'.format(transid, e))
 
-            return {
-                'transid': transid,
-                'link': external_link,
-                'shopping_cart_gid': self.get_shopping_cart_gid()
-            }
+                return polling.POLL_ERROR, None
+
+            if isinstance(external_link, enums.EWebAccountResult):
+                return polling.POLL_ERROR, None
 
-        log.error(u'Finished polling but could not obtain transaction link from external link')
+            if not external_link:
+                return polling.POLL_PENDING, None
 
-        return enums.EWebAccountResult.Failed.value
+            return polling.POLL_DONE, external_link
 
-    def poll_transaction_status(self, transid, times=25, delay=0.5):
-        result = EResult.Pending
-        attemps = times
+        log.info(u'Getting external link for transid {}'.format(transid))
 
-        while result != EResult.OK and attemps > 0:
-            log.info(
-                u'Polling transaction status for transid {0} ({1}/{2})'.format(
-                    transid,
-                    attemps,
-                    times
-                )
+        summary = polling.Poller(deadline=deadline, max_errors=3, max_pending=10).run(poll)
+
+        log.info(
+            u'Polled external link for transid {0}: {1} after {2} attempts in {3:.2f}s'.format(
+                transid,
+                summary.outcome,
+                summary.attempts,
+                summary.elapsed
             )
+        )
+
+        if summary.outcome != polling.POLL_DONE:
+            log.error(u'Finished polling but could not obtain transaction link from external link')
+
+            return enums.EWebAccountResult.Failed.value
+
+        return {
+            'transid': transid,
+            'link': summary.result,
+            'shopping_cart_gid': self.get_shopping_cart_gid()
+        }
+
+    def poll_transaction_status(self, transid, times=25, delay=0.5, deadline=60):
+        def poll():
+            try:
+                transaction_status = self.get_transaction_status(transid)
+            except requests.RequestException, e:
+                log.error(u'Failed to get transaction status for transid {0}. Raised {1}'.format(transid, e))
 
-            transaction_status = self.get_transaction_status(transid)
+                return polling.POLL_ERROR, EResult.Pending
 
             if isinstance(transaction_status, enums.EWebAccountResult):
                 log.error(
@@ -516,22 +918,38 @@ class WebAccount(object):
                     )
                 )
 
-                continue
+                return polling.POLL_ERROR, EResult.Pending
 
             result = EResult(transaction_status.get('success'))
-            attemps -= 1
 
-            time.sleep(delay)
+            if not transactions.is_terminal(result):
+                return polling.POLL_PENDING, result
+
+            return polling.POLL_DONE, result
 
-        return result
+        log.info(u'Polling transaction status for transid {}'.format(transid))
+
+        summary = polling.Poller(deadline=deadline, base_delay=delay, max_pending=times).run(poll)
+
+        log.info(
+            u'Polled transaction status for transid {0}: {1} ({2}) after {3} attempts in {4:.2f}s'.format(
+                transid,
+                summary.outcome,
+                repr(summary.result),
+                summary.attempts,
+                summary.elapsed
+            )
+        )
+
+        return summary
 
 
 class EdgeBot(object):
-    def __init__(self, network_id):
+    def __init__(self, network_id, web_account=None):
         self.network_id = network_id
-        self.web_account = WebAccount(network_id)
+        self.web_account = web_account or WebAccount(network_id)
 
-    def add_subids_to_cart(self, items):
+    def add_subids_to_cart(self, items, batch=None):
         '''
             items:
 
@@ -566,53 +984,262 @@ class EdgeBot(object):
             }
         '''
 
-        failed_shopping_cart_gids = []
+        response = {
+            'failed_shopping_cart_gids': [],
+            'failed_items': [],
+            'items': []
+        }
+
+        if batch is None:
+            batch = getattr(config, 'CART_BATCH_ADD', False)
+
+        if batch:
+            batch_size = getattr(config, 'CART_BATCH_SIZE', 20)
+
+            for index in range(0, len(items), batch_size):
+                self.lost_items = []
+                self.add_batch(items[index:index + batch_size], response)
+
+                while len(self.lost_items):
+                    lost_items = self.lost_items
+                    self.lost_items = []
+
+                    log.info(u'Restoring {} subids lost with a previous cart'.format(len(lost_items)))
+
+                    self.add_batch(lost_items, response)
+        else:
+            for item in items:
+                self.add_item(item, response)
+
+        response['shoppingCartGID'] = self.web_account.get_shopping_cart_gid()
+
+        return response
+
+    def add_item(self, item, response):
+        current_shopping_cart_gid = self.web_account.get_shopping_cart_gid()
+
+        sub_id = item.get('sub_id')
+        result = self.web_account.add_subid_to_cart(sub_id)
+
+        if isinstance(result, enums.EWebAccountResult):
+            log.error(u'Failed to push subid to cart, received {}'.format(repr(result)))
+
+            return
+
+        shopping_cart_gid = self.web_account.get_shopping_cart_gid()
+
+        if current_shopping_cart_gid and shopping_cart_gid != current_shopping_cart_gid and result == enums.ECartResult.Added:
+            # The account logged in again and could not keep its cart, the
+            # subid went to a new one and the items added before are gone.
 
-        failed_items = []
-        success_items = []
+            log.info(u'Cart with shopping cart gid {0} was replaced by {1}'.format(current_shopping_cart_gid, shopping_cart_gid))
+
+            response['failed_shopping_cart_gids'].append(current_shopping_cart_gid)
+            response['items'] = [dict(item)]
+
+            return
+
+        if result == enums.ECartResult.Failed:
+            log.info(u'Failed to add subid {} to cart'.format(sub_id))
+        elif result == enums.ECartResult.CartDissapeared:
+            log.info(u'Subid {} caused to dissapear'.format(sub_id))
+
+            response['failed_shopping_cart_gids'].append(current_shopping_cart_gid)
+            response['failed_items'].append(dict(item))
+
+            response['items'] = []
+        elif result == enums.ECartResult.CartNotGifteable:
+            log.info(u'Subid {} caused cart to be not gifteable'.format(sub_id))
+
+            self.web_account.remove_last_cart_item()
+        elif result == enums.ECartResult.CartReset:
+            log.info(u'Cart with shopping cart gid {} has been reset'.format(current_shopping_cart_gid))
+
+            response['failed_shopping_cart_gids'].append(current_shopping_cart_gid)
+            response['items'] = []
+        elif result == enums.ECartResult.Added:
+            log.info(u'Subid {} added successfully'.format(sub_id))
+
+            response['items'].append(dict(item))
+
+    def add_batch(self, batch, response):
+        '''
+            Pushes a batch and checks the resulting cart once. Pushing stops
+            at the first subid that makes the cart not gifteable, its line is
+            the newest one and is removed alone before the rest of the batch
+            is pushed. When the cart does not match otherwise, the batch
+            items are taken out of it and the batch is bisected until
+            add_item can classify the offending subid.
+        '''
+
+        if not len(batch):
+            return
+
+        if len(batch) == 1:
+            previous_items = response['items']
+
+            self.add_item(batch[0], response)
+
+            if response['items'] is not previous_items:
+                self.lost_items.extend(previous_items)
+
+            return
+
+        shopping_cart_gid = self.web_account.get_shopping_cart_gid()
+        previous_snapshot = self.web_account.cart.get(shopping_cart_gid)
+        result = self.web_account.push_subids_to_cart([item.get('sub_id') for item in batch])
+
+        if isinstance(result, enums.EWebAccountResult):
+            log.error(u'Failed to push batch of {0} subids to cart, received {1}'.format(len(batch), repr(result)))
+
+            return
+
+        pushed, snapshot = result
+
+        self.check_batch(batch[:pushed], snapshot, previous_snapshot, shopping_cart_gid, response)
+        self.add_batch(batch[pushed:], response)
+
+    def check_batch(self, batch, snapshot, previous_snapshot, shopping_cart_gid, response):
+        current_shopping_cart_gid = self.web_account.get_shopping_cart_gid()
+
+        if not current_shopping_cart_gid or (shopping_cart_gid and current_shopping_cart_gid != shopping_cart_gid):
+            log.info(u'Cart with shopping cart gid {} has been reset'.format(shopping_cart_gid))
+
+            self.drop_cart(shopping_cart_gid, response['items'], response)
+
+        # The same subid can be in the cart more than once, so cart lines are
+        # counted against the items added before the batch first, then
+        # against the batch. A line left over is a duplicate, unless the
+        # cart held it before this order (or that cart is not known).
+
+        packageids = Counter(line.packageid for line in snapshot.items)
+
+        kept_items, lost_items = self.take_lines(response['items'], packageids)
+        added_items, missing_items = self.take_lines(batch, packageids)
+
+        if previous_snapshot is None:
+            packageids = Counter()
+        else:
+            packageids -= Counter(line.packageid for line in previous_snapshot.items) - Counter(str(item.get('sub_id')) for item in response['items'])
+
+        if not len(lost_items) and not len(missing_items) and not sum(packageids.values()):
+            if not snapshot.is_gifteable():
+                remaining_snapshot = self.remove_not_gifteable(batch[-1])
+
+                if remaining_snapshot is not None:
+                    batch = added_items = batch[:-1]
+                    snapshot = remaining_snapshot
+
+            if snapshot.is_gifteable():
+                log.info(u'Batch of {} subids added successfully'.format(len(batch)))
+
+                response['items'].extend(dict(item) for item in batch)
+
+                return
+
+        if len(lost_items):
+            log.info(u'{} subids went missing from the cart'.format(len(lost_items)))
+
+            self.lost_items.extend(lost_items)
+            response['items'] = kept_items
+
+        if current_shopping_cart_gid and snapshot.is_gifteable() and self.remove_lines(packageids, snapshot):
+            log.info(u'Batch of {0} subids added, {1} missing'.format(len(batch), len(missing_items)))
+
+            response['items'].extend(dict(item) for item in added_items)
+
+            return self.bisect_batch(missing_items, response)
+
+        batch_lines = packageids + Counter(str(item.get('sub_id')) for item in added_items)
+
+        if not current_shopping_cart_gid or not self.remove_lines(batch_lines, snapshot):
+            self.drop_cart(current_shopping_cart_gid, response['items'], response)
+
+            self.web_account.reset_shopping_cart_gid()
+            self.web_account.save_session()
+
+        self.bisect_batch(batch, response)
+
+    def remove_not_gifteable(self, item):
+        '''
+            Removes the newest cart line, the one of the subid that took the
+            gift button away, and returns the CartSnapshot left or None if
+            it could not be removed.
+        '''
+
+        log.info(u'Subid {} caused cart to be not gifteable'.format(item.get('sub_id')))
+
+        if self.web_account.remove_last_cart_item() != enums.ECartResult.Removed:
+            return None
+
+        snapshot = self.web_account.get_cart()
+
+        if isinstance(snapshot, enums.EWebAccountResult):
+            return None
+
+        return snapshot
+
+    def drop_cart(self, shopping_cart_gid, cart_items, response):
+        if shopping_cart_gid and shopping_cart_gid not in response['failed_shopping_cart_gids']:
+            response['failed_shopping_cart_gids'].append(shopping_cart_gid)
+
+        # Subids held by a dropped cart were fine, they get pushed again once
+        # the whole batch went through.
+
+        self.lost_items.extend(cart_items)
+        response['items'] = []
+
+    def take_lines(self, items, packageids):
+        '''
+            Takes a line off the packageids Counter for every item that has
+            one left and returns the items that had one and the ones that
+            did not.
+        '''
+
+        present_items = []
+        missing_items = []
 
         for item in items:
-            current_shopping_cart_gid = self.web_account.get_shopping_cart_gid()
+            sub_id = str(item.get('sub_id'))
 
-            sub_id = item.get('sub_id')
-            result = self.web_account.add_subid_to_cart(sub_id)
+            if packageids[sub_id] > 0:
+                packageids[sub_id] -= 1
+                present_items.append(item)
+            else:
+                missing_items.append(item)
 
-            if isinstance(result, enums.EWebAccountResult):
-                log.error(u'Failed to push subid to cart, received {}'.format(repr(result)))
+        return present_items, missing_items
 
-                continue
+    def remove_lines(self, packageids, snapshot):
+        '''
+            Removes as many cart lines of each packageid as the Counter
+            holds, newest lines first, so older lines with the same subids
+            (the items added before the batch) stay in the cart.
+        '''
 
-            if result == enums.ECartResult.Failed:
-                log.info(u'Failed to add subid {} to cart'.format(sub_id))
-            elif result == enums.ECartResult.CartDissapeared:
-                log.info(u'Subid {} caused to dissapear'.format(sub_id))
+        packageids = Counter(packageids)
 
-                failed_shopping_cart_gids.append(current_shopping_cart_gid)
-                failed_items.append(dict(item))
+        for line in snapshot.items:
+            if packageids[line.packageid] <= 0:
+                continue
 
-                success_items = []
-            elif result == enums.ECartResult.CartNotGifteable:
-                log.info(u'Subid {} caused cart to be not gifteable'.format(sub_id))
+            if not line.remove_gid:
+                return False
 
-                self.web_account.remove_last_cart_item()
-            elif result == enums.ECartResult.CartReset:
-                log.info(u'Cart with shopping cart gid {} has been reset'.format(current_shopping_cart_gid))
+            if self.web_account.remove_gid_from_cart(line.remove_gid) != enums.ECartResult.Removed:
+                return False
 
-                failed_shopping_cart_gids.append(current_shopping_cart_gid)
-                success_items = []
-            elif result == enums.ECartResult.Added:
-                log.info(u'Subid {} added successfully'.format(sub_id))
+            packageids[line.packageid] -= 1
 
-                success_items.append(dict(item))
+        return True
 
-        response = {
-            'failed_shopping_cart_gids': failed_shopping_cart_gids,
-            'shoppingCartGID': self.web_account.get_shopping_cart_gid(),
-            'failed_items': failed_items,
-            'items': success_items
-        }
+    def bisect_batch(self, batch, response):
+        middle = len(batch) // 2
 
-        return response
+        log.info(u'Bisecting batch of {} subids'.format(len(batch)))
+
+        self.add_batch(batch[:middle], response)
+        self.add_batch(batch[middle:], response)
 
     def checkout_cart(self, giftee_account_id):
         shopping_cart_gid = self.web_account.get_shopping_cart_gid()
@@ -620,14 +1247,19 @@ class EdgeBot(object):
         if not shopping_cart_gid:
             return enums.ETransactionResult.ShoppingCartGIDNotFound.value
 
-        cart_object = self.web_account.get_cart_object()
+        snapshot = self.web_account.get_cart()
+
+        if isinstance(snapshot, enums.EWebAccountResult):
+            log.error(u'Failed to retrieve cart before checkout, received {}'.format(repr(snapshot)))
+
+            return enums.ETransactionResult.Fail.value
 
         US_CURRENCY_REGEX = r'\$(.*)'
 
         payment_method = 'bitcoin'
 
-        subtotal_matches = re.findall(US_CURRENCY_REGEX, cart_object.subtotal, re.DOTALL)
-        balance_matches = re.findall(US_CURRENCY_REGEX, cart_object.balance, re.DOTALL)
+        subtotal_matches = re.findall(US_CURRENCY_REGEX, snapshot.subtotal or '', re.DOTALL)
+        balance_matches = re.findall(US_CURRENCY_REGEX, snapshot.balance or '', re.DOTALL)
 
         if len(subtotal_matches) and len(balance_matches):
             subtotal = float(subtotal_matches[0])
@@ -652,8 +1284,10 @@ class EdgeBot(object):
         if transid == '-1':
             log.info(u'Received transid -1, account has too many purchases in the last few hours')
 
+            accounts.start_cooldown(self.network_id)
+
             self.web_account.reset_shopping_cart_gid()
-            self.web_account.save_session_to_file()
+            self.web_account.save_session()
 
             return enums.ETransactionResult.TooManyPurchases.value
 
@@ -661,7 +1295,7 @@ class EdgeBot(object):
             log.error(u'Failed to initialize transaction, received {}'.format(repr(transid)))
 
             self.web_account.reset_shopping_cart_gid()
-            self.web_account.save_session_to_file()
+            self.web_account.save_session()
 
             return enums.ETransactionResult.Fail.value
 
@@ -687,7 +1321,7 @@ class EdgeBot(object):
             )
 
             self.web_account.reset_shopping_cart_gid()
-            self.web_account.save_session_to_file()
+            self.web_account.save_session()
 
             return transaction_final_price.value
 
@@ -704,7 +1338,12 @@ class EdgeBot(object):
 
         transaction_data = self.web_account.finalize_transaction(transid)
 
-        if isinstance(transaction_data, enums.EWebAccountResult):
+        if transaction_data in (enums.EWebAccountResult.NotLoggedIn, enums.EWebAccountResult.UnknownException):
+            # The POST may have been processed before the session or the
+            # connection dropped, polling the status decides.
+
+            log.info(u'Finalizing transid {0} returned {1}, polling its status'.format(transid, repr(transaction_data)))
+        elif isinstance(transaction_data, enums.EWebAccountResult):
             log.error(
                 u'Failed to finalize transaction, received {}'.format(
                     repr(transaction_data)
@@ -713,15 +1352,13 @@ class EdgeBot(object):
 
             return enums.ETransactionResult.Fail.value
 
-        result = self.web_account.poll_transaction_status(transid, times=5)
+        result = self.web_account.poll_transaction_status(transid, times=5).result
 
         if result == EResult.OK:
             log.info(u'Transaction finalized successfully')
 
-            self.cart_count = 0
-
             self.web_account.reset_shopping_cart_gid()
-            self.web_account.save_session_to_file()
+            self.web_account.save_session()
 
         return {
             'result': result.value,
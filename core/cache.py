@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    '''
+        Dict with a maximum size and a time to live per entry, for per-user
+        state kept by long running processes.
+
+        Entries expire `ttl` seconds after they were last set. When full,
+        the entry set the longest ago is evicted first.
+    '''
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        self.data = OrderedDict()
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def expire(self):
+        if self.ttl is None:
+            return
+
+        now = time.time()
+
+        # Entries are kept in set order for expiry, so the first one that is
+        # still alive ends the scan.
+
+        while len(self.data):
+            key, (expires_at, value) = next(self.data.iteritems())
+
+            if expires_at > now:
+                break
+
+            del self.data[key]
+            self.expirations += 1
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (time.time() + self.ttl if self.ttl is not None else None, value)
+
+            self.expire()
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.expire()
+
+            return self.data[key][1]
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            self.expire()
+
+            return key in self.data
+
+    def __len__(self):
+        with self.lock:
+            self.expire()
+
+            return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+
+        if entry is None:
+            return default
+
+        return entry[1]
+
+    def items(self):
+        with self.lock:
+            self.expire()
+
+            return [(key, value) for key, (expires_at, value) in self.data.items()]
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import re
+
+from collections import namedtuple
+
+from core import extractors
+
+ITEM_ADDED_MESSAGE = 'YOUR ITEM\'S BEEN ADDED!'
+ITEM_REMOVED_MESSAGE = 'YOUR ITEM HAS BEEN REMOVED!'
+GIFT_CHECKOUT_LINK = 'https://store.steampowered.com/checkout/?purchasetype=gift'
+
+
+class CartLineItem(namedtuple('CartLineItem', ['appid', 'packageid', 'title', 'price', 'remove_gid'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_item(cls, item):
+        remove_gid_matches = re.findall(r'([0-9]+)', item.remove_button or '', re.DOTALL)
+
+        return cls(
+            appid=item.appid,
+            packageid=item.packageid,
+            title=item.title,
+            price=item.price,
+            remove_gid=remove_gid_matches[0] if len(remove_gid_matches) else None
+        )
+
+
+class CartSnapshot(namedtuple('CartSnapshot', ['count', 'status_message', 'checkout_button', 'subtotal', 'balance', 'items'])):
+    '''
+        Immutable view of a /cart response, parsed once and shared by every
+        check made against that response.
+    '''
+
+    __slots__ = ()
+
+    @classmethod
+    def from_html(cls, html, extractor=None):
+        cart_object = (extractor or extractors.get_extractor()).cart(html)
+
+        if cart_object is None:
+            return None
+
+        line_items = tuple(CartLineItem.from_item(item) for item in cart_object.items or [])
+
+        return cls(
+            count=len(line_items),
+            status_message=cart_object.cart_status_message,
+            checkout_button=cart_object.cart_checkout_button,
+            subtotal=cart_object.subtotal,
+            balance=cart_object.balance,
+            items=line_items
+        )
+
+    def item_was_added(self):
+        return self.status_message == ITEM_ADDED_MESSAGE
+
+    def item_was_removed(self):
+        return self.status_message == ITEM_REMOVED_MESSAGE
+
+    def is_gifteable(self):
+        return GIFT_CHECKOUT_LINK in (self.checkout_button or '')
+
+
+def has_gift_button(html):
+    '''
+        Whether a raw /cart page offers to check out as a gift, without
+        parsing it into a CartSnapshot.
+    '''
+
+    return GIFT_CHECKOUT_LINK in (html or '')
+
+
+EMPTY_CART = CartSnapshot(count=0, status_message=None, checkout_button=None, subtotal=None, balance=None, items=())
+
+
+class CartMirror(object):
+    '''
+        Last known cart of a WebAccount, kept from the /cart page every cart
+        POST answers with, so the cart is only downloaded again when the
+        mirror was invalidated or the shoppingCartGID cookie no longer
+        matches the cart it was taken from.
+    '''
+
+    def __init__(self):
+        self.snapshot = None
+        self.shopping_cart_gid = None
+
+    def update(self, snapshot, shopping_cart_gid):
+        self.snapshot = snapshot
+        self.shopping_cart_gid = shopping_cart_gid
+
+    def empty(self):
+        self.update(EMPTY_CART, None)
+
+    def invalidate(self):
+        self.update(None, None)
+
+    def get(self, shopping_cart_gid):
+        '''
+            Returns the CartSnapshot for shopping_cart_gid, or None when the
+            mirror does not hold that cart.
+        '''
+
+        if self.snapshot is None or self.shopping_cart_gid != shopping_cart_gid:
+            return None
+
+        return self.snapshot
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+from multiprocessing.pool import ThreadPool
+
+import config
+
+from core import bot
+from core import enums
+from core.pool import POOL
+
+log = bot.log
+
+# Operations AccountEngine.call runs, by the object that implements them.
+
+OPERATIONS = {
+    'add_subids_to_cart': 'edge_bot',
+    'checkout_cart': 'edge_bot',
+    'reset_shopping_cart_gid': 'web_account',
+    'get_transaction_status': 'web_account',
+    'get_external_link_from_transid': 'web_account'
+}
+
+
+class AccountEngine(object):
+    '''
+        Drives WebAccount and EdgeBot operations for many accounts at once
+        from a single process.
+
+        Calls run on a bounded pool of workers (greenlets when the process is
+        gevent patched, threads otherwise), the accounts come from the warm
+        account pool, which also keeps two calls for the same account from
+        overlapping, and every session goes through the shared keep-alive
+        transport of core.transport. Calls return the same results as the
+        underlying synchronous methods.
+    '''
+
+    def __init__(self, size=None, accounts=None):
+        self.size = size or getattr(config, 'ACCOUNT_ENGINE_SIZE', 16)
+        self.accounts = accounts or POOL
+
+        self.workers = ThreadPool(self.size)
+
+    def run(self, calls):
+        '''
+            calls: [(network_id, operation, args, kwargs), ...]
+
+            Returns the result of every call, in order.
+        '''
+
+        pending = [self.workers.apply_async(self.safe_call, call) for call in calls]
+
+        return [result.get() for result in pending]
+
+    def call(self, network_id, operation, args=(), kwargs=None):
+        if operation not in OPERATIONS:
+            raise ValueError(u'Unknown operation {}'.format(operation))
+
+        with self.accounts.account(network_id) as web_account:
+            if OPERATIONS[operation] == 'edge_bot':
+                target = bot.EdgeBot(network_id, web_account=web_account)
+            else:
+                target = web_account
+
+            return getattr(target, operation)(*args, **(kwargs or {}))
+
+    def safe_call(self, network_id, operation, args=(), kwargs=None):
+        try:
+            return self.call(network_id, operation, args, kwargs)
+        except Exception, e:
+            log.error(u'{0} for network_id {1} raised {2}'.format(operation, network_id, e))
+
+            return enums.EWebAccountResult.UnknownException
+
+    def close(self):
+        self.workers.close()
+        self.workers.join()
+
+
+engine = None
+
+
+def get_engine():
+    global engine
+
+    if engine is None:
+        engine = AccountEngine()
+
+    return engine
@@ -10,6 +10,7 @@ class EWebAccountResult(IntEnum):
     Failed = 3
     UnknownException = 4
     ResponseNotSerializable = 5
+    NotLoggedIn = 6
 
 
 class ECartResult(IntEnum):
@@ -34,3 +35,7 @@ class EdgeResult(IntEnum):
     IncompleteForm = 1
     ParamNotSerializable = 2
     TaskNotFound = 3
+    TransactionNotFound = 4
+    NoAccountAvailable = 5
+    AccountCoolingDown = 6
+    TooManyStreams = 7
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import re
+
+from collections import namedtuple
+from HTMLParser import HTMLParser
+
+import config
+
+from core import items
+
+TAG_REGEX_CACHE = {}
+ATTR_REGEX = re.compile(r'([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?')
+MARKUP_REGEX = re.compile(r'<[^>]*>')
+
+html_parser = HTMLParser()
+
+FastSteamCart = namedtuple(
+    'FastSteamCart',
+    ['count', 'subtotal', 'balance', 'cart_status_message', 'cart_checkout_button', 'items']
+)
+
+FastSteamCartItem = namedtuple(
+    'FastSteamCartItem',
+    ['appid', 'packageid', 'title', 'price', 'remove_button']
+)
+
+FastExternalForm = namedtuple('FastExternalForm', ['link'])
+
+
+class DemiurgeExtractor(object):
+    '''
+        Full document extraction through the demiurge items.
+    '''
+
+    name = 'demiurge'
+
+    def cart(self, html):
+        cart_results = items.SteamCart.all_from(html)
+
+        if not len(cart_results):
+            return None
+
+        return cart_results[0]
+
+    def external_form(self, html):
+        forms = items.ExternalForm.all_from(html)
+
+        if not len(forms):
+            return None
+
+        return forms[0]
+
+
+class FastExtractor(object):
+    '''
+        Targeted extraction that only looks at the fragments WebAccount
+        needs, without building a document tree.
+
+        Returns objects with the same attributes as items.SteamCart,
+        items.SteamCartItem and items.ExternalForm.
+    '''
+
+    name = 'fast'
+
+    def cart(self, html):
+        if not html:
+            return None
+
+        cart_item_list = find_element(html, 'div', cls='cart_item_list')
+        cart_items = []
+
+        if cart_item_list:
+            start, end = element_inner_bounds(html, 'div', cart_item_list)
+            rows = list(iter_elements(html, 'div', cls='cart_row', start=start, end=end))
+
+            # A row runs up to the next one, which spares matching the
+            # closing tag of every row.
+
+            for index, row in enumerate(rows):
+                row_end = rows[index + 1][0] if index + 1 < len(rows) else end
+                cart_items.append(self.cart_item(html, row, row_end))
+
+        checkout_button = find_element(html, 'a', cls='continue')
+
+        return FastSteamCart(
+            count=element_text(html, 'span', find_element(html, 'span', id='cart_item_count_value')),
+            subtotal=element_text(html, 'div', find_element(html, 'div', id='cart_price_total')),
+            balance=element_text(html, 'a', find_element(html, 'a', id='header_wallet_balance')),
+            cart_status_message=element_text(html, 'div', find_element(html, 'div', cls='cart_status_message')),
+            cart_checkout_button=checkout_button[2].get('href') if checkout_button else None,
+            items=cart_items
+        )
+
+    def cart_item(self, html, row, end):
+        start = row[1]
+
+        title = None
+        price = None
+
+        description = find_element(html, 'div', cls='cart_item_desc', start=start, end=end)
+
+        if description:
+            title = element_text(html, 'a', find_element(html, 'a', start=description[1], end=end))
+
+        price_block = find_element(html, 'div', cls='cart_item_price', start=start, end=end)
+
+        if price_block:
+            price_start, price_end = element_inner_bounds(html, 'div', price_block)
+            prices = list(iter_elements(html, 'div', cls='price', start=price_start, end=price_end))
+
+            if len(prices):
+                price = element_text(html, 'div', prices[-1])
+
+        remove_link = find_element(html, 'a', cls='remove_link', start=start, end=end)
+
+        return FastSteamCartItem(
+            appid=row[2].get('data-ds-appid'),
+            packageid=row[2].get('data-ds-packageid'),
+            title=title,
+            price=price,
+            remove_button=remove_link[2].get('href') if remove_link else None
+        )
+
+    def external_form(self, html):
+        form = find_element(html or '', 'form', id='externalForm')
+
+        if not form:
+            return None
+
+        return FastExternalForm(link=form[2].get('action'))
+
+
+def tag_regex(tag):
+    if tag not in TAG_REGEX_CACHE:
+        TAG_REGEX_CACHE[tag] = re.compile(r'<(/?){}(?=[\s>/])[^>]*>'.format(tag), re.IGNORECASE)
+
+    return TAG_REGEX_CACHE[tag]
+
+
+def parse_attrs(raw):
+    attrs = {}
+
+    for match in ATTR_REGEX.finditer(raw):
+        name, double_quoted, single_quoted, bare = match.groups()
+        value = double_quoted if double_quoted is not None else single_quoted if single_quoted is not None else bare
+
+        if value and '&' in value:
+            value = html_parser.unescape(value)
+
+        attrs[name.lower()] = value
+
+    return attrs
+
+
+def iter_elements(html, tag, id=None, cls=None, start=0, end=None):
+    '''
+        Yields (open_start, open_end, attrs) for every `tag` opening tag in
+        html[start:end] matching the given id or class.
+
+        When an id or class is given, candidates are located by searching
+        for its literal value and walking back to the enclosing tag.
+    '''
+
+    end = len(html) if end is None else end
+    needle = id if id is not None else cls
+
+    if needle is None:
+        for match in tag_regex(tag).finditer(html, start, end):
+            if not match.group(1):
+                yield match.start(), match.end(), parse_attrs(match.group(0)[len(tag) + 1:-1])
+
+        return
+
+    position = html.find(needle, start, end)
+
+    while position != -1:
+        open_start = html.rfind('<', start, position)
+        open_end = html.find('>', position, end)
+
+        if open_start == -1 or open_end == -1:
+            return
+
+        if is_open_tag(html, tag, open_start) and html.rfind('>', open_start, position) == -1:
+            attrs = parse_attrs(html[open_start + len(tag) + 1:open_end])
+
+            id_matches = id is None or attrs.get('id') == id
+            cls_matches = cls is None or cls in (attrs.get('class') or '').split()
+
+            if id_matches and cls_matches:
+                yield open_start, open_end + 1, attrs
+
+        position = html.find(needle, open_end, end)
+
+
+def is_open_tag(html, tag, position):
+    name_end = position + len(tag) + 1
+
+    return html[position + 1:name_end].lower() == tag and html[name_end:name_end + 1] in (' ', '\t', '\n', '\r', '>', '/')
+
+
+def find_element(html, tag, id=None, cls=None, start=0, end=None):
+    for element in iter_elements(html, tag, id=id, cls=cls, start=start, end=end):
+        return element
+
+    return None
+
+
+def element_inner_bounds(html, tag, element):
+    '''
+        Returns the (start, end) of the content of an element, following
+        nested tags of the same name up to its matching closing tag.
+    '''
+
+    any_regex = tag_regex(tag)
+    depth = 1
+
+    for match in any_regex.finditer(html, element[1]):
+        if match.group(1):
+            depth -= 1
+        elif not match.group(0).endswith('/>'):
+            depth += 1
+
+        if depth == 0:
+            return element[1], match.start()
+
+    return element[1], len(html)
+
+
+def element_text(html, tag, element):
+    if not element:
+        return None
+
+    start, end = element_inner_bounds(html, tag, element)
+    text = MARKUP_REGEX.sub(' ', html[start:end])
+
+    if '&' in text:
+        text = html_parser.unescape(text)
+
+    return u' '.join(text.split())
+
+
+EXTRACTORS = {
+    DemiurgeExtractor.name: DemiurgeExtractor(),
+    FastExtractor.name: FastExtractor()
+}
+
+
+def get_extractor(name=None):
+    return EXTRACTORS[name or getattr(config, 'CART_EXTRACTOR', DemiurgeExtractor.name)]
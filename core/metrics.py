@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import redis
+
+import config
+
+from core import shared
+
+DURATION_BUCKETS = getattr(
+    config,
+    'METRICS_DURATION_BUCKETS',
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+HISTOGRAMS = {
+    'steam_request_duration_seconds': u'Duration of WebAccount calls to the Steam store by endpoint and outcome.',
+    'task_duration_seconds': u'Duration of edge tasks by task name and outcome.',
+    'task_queue_wait_seconds': u'Time edge tasks spent in the queue before running.'
+}
+
+COUNTERS = {
+    'steam_cart_results_total': u'Results returned by WebAccount cart operations.',
+    'steam_session_expired_total': u'Steam answers that found the session logged out.',
+    'task_lease_retries_total': u'Edge tasks put back in the queue because their account was busy.'
+}
+
+# Metrics live in Redis so every worker process and the Flask app share
+# them. Each metric is a hash under steamcommerce:metrics:<name> whose
+# fields are "<labels>|<suffix>", the suffix being a bucket upper bound,
+# sum or count for histograms and value for counters. Buckets are not
+# stored cumulative, they get added up when rendering.
+
+
+def metric_key(name):
+    return shared.key('metrics', name)
+
+
+def format_labels(labels):
+    return u','.join(
+        u'{0}="{1}"'.format(
+            name,
+            unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for name, value in sorted(labels.items())
+    )
+
+
+def bucket_for(value):
+    for bound in DURATION_BUCKETS:
+        if value <= bound:
+            return str(bound)
+
+    return '+Inf'
+
+
+def observe(name, value, **labels):
+    label_str = format_labels(labels)
+
+    try:
+        pipe = shared.get_redis().pipeline(transaction=False)
+        pipe.hincrby(metric_key(name), u'{0}|{1}'.format(label_str, bucket_for(value)), 1)
+        pipe.hincrby(metric_key(name), u'{0}|count'.format(label_str), 1)
+        pipe.hincrbyfloat(metric_key(name), u'{0}|sum'.format(label_str), value)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def incr(name, amount=1, **labels):
+    try:
+        shared.get_redis().hincrby(metric_key(name), u'{0}|value'.format(format_labels(labels)), amount)
+    except redis.RedisError:
+        pass
+
+
+def read_metric(name):
+    '''
+        Returns {labels: {suffix: value}} for a metric.
+    '''
+
+    series = {}
+
+    for field, value in shared.get_redis().hgetall(metric_key(name)).items():
+        label_str, suffix = field.decode('utf-8').rsplit(u'|', 1)
+        series.setdefault(label_str, {})[suffix] = float(value)
+
+    return series
+
+
+def format_sample(name, label_str, value):
+    if value == int(value):
+        value = int(value)
+
+    if label_str:
+        return u'{0}{{{1}}} {2}'.format(name, label_str, value)
+
+    return u'{0} {1}'.format(name, value)
+
+
+def join_labels(label_str, extra):
+    return u','.join(part for part in (label_str, extra) if part)
+
+
+def render_histogram(name, lines):
+    for label_str, values in sorted(read_metric(name).items()):
+        cumulative = 0
+
+        for bound in DURATION_BUCKETS:
+            cumulative += values.get(str(bound), 0)
+            lines.append(format_sample(name + '_bucket', join_labels(label_str, u'le="{}"'.format(bound)), cumulative))
+
+        lines.append(format_sample(name + '_bucket', join_labels(label_str, u'le="+Inf"'), values.get('count', 0)))
+        lines.append(format_sample(name + '_sum', label_str, values.get('sum', 0)))
+        lines.append(format_sample(name + '_count', label_str, values.get('count', 0)))
+
+
+def render_counter(name, lines):
+    for label_str, values in sorted(read_metric(name).items()):
+        lines.append(format_sample(name, label_str, values.get('value', 0)))
+
+
+def render():
+    '''
+        Returns every metric in the Prometheus text exposition format.
+    '''
+
+    lines = []
+
+    for name, description in sorted(HISTOGRAMS.items()):
+        lines.append(u'# HELP {0} {1}'.format(name, description))
+        lines.append(u'# TYPE {} histogram'.format(name))
+
+        render_histogram(name, lines)
+
+    for name, description in sorted(COUNTERS.items()):
+        lines.append(u'# HELP {0} {1}'.format(name, description))
+        lines.append(u'# TYPE {} counter'.format(name))
+
+        render_counter(name, lines)
+
+    return u'\n'.join(lines) + u'\n'
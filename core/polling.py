@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+import random
+
+from collections import namedtuple
+
+POLL_DONE = 'done'
+POLL_PENDING = 'pending'
+POLL_ERROR = 'error'
+
+PollSummary = namedtuple('PollSummary', ['outcome', 'result', 'attempts', 'errors', 'elapsed'])
+
+
+def backoff(attempt, base_delay=0.5, max_delay=8, jitter=0.25):
+    '''
+        Exponential delay for the given (zero based) attempt, capped at
+        max_delay and spread by +/- jitter so pollers do not line up.
+    '''
+
+    delay = min(max_delay, base_delay * (2 ** attempt))
+
+    return max(0, delay * (1 + random.uniform(-jitter, jitter)))
+
+
+class Poller(object):
+    '''
+        Calls `poll` until it reports POLL_DONE, the wall-clock deadline
+        passes, or either the transport error or the pending budget runs out.
+
+        `poll` returns a (state, result) tuple where state is one of
+        POLL_DONE, POLL_PENDING or POLL_ERROR.
+    '''
+
+    def __init__(self, deadline=30, base_delay=0.5, max_delay=8, jitter=0.25, max_errors=5, max_pending=25):
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_errors = max_errors
+        self.max_pending = max_pending
+
+    def run(self, poll):
+        started_at = time.time()
+
+        attempts = 0
+        errors = 0
+        pending = 0
+
+        result = None
+
+        while True:
+            attempts += 1
+            state, result = poll()
+
+            if state == POLL_DONE:
+                return PollSummary(POLL_DONE, result, attempts, errors, time.time() - started_at)
+
+            if state == POLL_ERROR:
+                errors += 1
+
+                if errors >= self.max_errors:
+                    return PollSummary('errors', result, attempts, errors, time.time() - started_at)
+
+                delay = backoff(errors - 1, self.base_delay, self.max_delay, self.jitter)
+            else:
+                pending += 1
+
+                if pending >= self.max_pending:
+                    return PollSummary('pending', result, attempts, errors, time.time() - started_at)
+
+                delay = backoff(pending - 1, self.base_delay, self.max_delay, self.jitter)
+
+            if time.time() - started_at + delay > self.deadline:
+                return PollSummary('deadline', result, attempts, errors, time.time() - started_at)
+
+            time.sleep(delay)
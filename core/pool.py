@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+import threading
+
+from contextlib import contextmanager
+
+import config
+
+from core import bot
+
+log = bot.log
+
+
+class AccountPool(object):
+    '''
+        Per-process pool of warm WebAccount objects keyed by network_id.
+
+        A cached account is handed out as is until its TTL expires, then it
+        gets revalidated against Steam before being reused. Accounts flagged
+        as invalid (login or cart errors) are dropped and rebuilt.
+    '''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        self.accounts = {}
+        self.account_locks = {}
+        self.validated_at = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+    def account_lock(self, network_id):
+        with self.lock:
+            return self.account_locks.setdefault(network_id, threading.RLock())
+
+    def get(self, network_id):
+        with self.account_lock(network_id):
+            web_account = self.accounts.get(network_id)
+
+            if web_account is not None and not web_account.is_valid:
+                self.drop(network_id)
+                web_account = None
+
+            if web_account is None:
+                self.misses += 1
+
+                log.info(u'Account pool miss for network_id {}'.format(network_id))
+
+                return self.build(network_id)
+
+            if time.time() - self.validated_at[network_id] > self.ttl:
+                self.revalidations += 1
+
+                if not self.revalidate(web_account):
+                    self.drop(network_id)
+                    self.misses += 1
+
+                    return self.build(network_id)
+
+                self.validated_at[network_id] = time.time()
+
+            self.hits += 1
+
+            web_account.sync_session()
+
+            return web_account
+
+    @contextmanager
+    def account(self, network_id):
+        '''
+            Hands out the pooled account for network_id and keeps it to the
+            caller until the block ends, so threads or greenlets sharing this
+            pool never drive the same account at once.
+        '''
+
+        with self.account_lock(network_id):
+            web_account = self.get(network_id)
+
+            try:
+                yield web_account
+            except Exception:
+                self.invalidate(network_id)
+
+                raise
+            finally:
+                web_account.flush_session()
+
+    def build(self, network_id):
+        web_account = bot.WebAccount(network_id)
+
+        with self.lock:
+            self.accounts[network_id] = web_account
+            self.validated_at[network_id] = time.time()
+
+        return web_account
+
+    def revalidate(self, web_account):
+        log.info(u'Revalidating pooled account {}'.format(web_account.account_name))
+
+        web_account.set_cart_count()
+
+        return web_account.is_valid
+
+    def drop(self, network_id):
+        with self.lock:
+            self.accounts.pop(network_id, None)
+            self.validated_at.pop(network_id, None)
+
+    def invalidate(self, network_id):
+        if network_id in self.accounts:
+            self.invalidations += 1
+
+            log.info(u'Invalidating pooled account for network_id {}'.format(network_id))
+
+        self.drop(network_id)
+
+    def stats(self):
+        return {
+            'size': len(self.accounts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'invalidations': self.invalidations
+        }
+
+
+POOL = AccountPool(ttl=getattr(config, 'ACCOUNT_POOL_TTL', 300))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import json
+import hashlib
+import threading
+
+FRIEND = 3
+
+FRIENDS = 'friends'
+INVITATIONS = 'invitations'
+
+
+class RosterView(object):
+    '''
+        Serialised list of friends or invitations for one roster version.
+        Pages are serialised on first use and kept with the view.
+    '''
+
+    def __init__(self, entries, ids=False):
+        if ids:
+            self.items = [entry['SteamID64'] for entry in entries]
+        else:
+            self.items = entries
+
+        self.body = json.dumps(self.items, sort_keys=True)
+        self.etag = '"{}"'.format(hashlib.md5(self.body).hexdigest())
+
+        self.pages = {}
+
+    def page(self, offset=0, limit=None):
+        '''
+            Returns (etag, body) for items[offset:offset + limit].
+        '''
+
+        if not offset and limit is None:
+            return self.etag, self.body
+
+        if (offset, limit) not in self.pages:
+            items = self.items[offset:offset + limit if limit is not None else None]
+
+            self.pages[(offset, limit)] = (
+                '"{0}-{1}-{2}"'.format(self.etag.strip('"'), offset, limit),
+                json.dumps(items, sort_keys=True)
+            )
+
+        return self.pages[(offset, limit)]
+
+
+class FriendRoster(object):
+    '''
+        Friends list of a SteamBot, indexed by SteamID64 and kept up to date
+        from the friends list events, so requests do not walk the whole
+        steamclient.friends or compute avatar urls every time.
+
+        Every change bumps the version, views are serialised once per
+        version and kind.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.entries = {}
+        self.version = 0
+        self.views = {}
+
+    def entry(self, steam_user):
+        return {
+            'relationship': int(steam_user.relationship),
+            'SteamID64': steam_user.steam_id.as_64,
+            'avatar_url': steam_user.get_avatar_url(),
+            'name': steam_user.name
+        }
+
+    def changed(self):
+        self.version += 1
+        self.views = {}
+
+    def update(self, steam_user):
+        entry = self.entry(steam_user)
+
+        with self.lock:
+            if self.entries.get(entry['SteamID64']) == entry:
+                return
+
+            self.entries[entry['SteamID64']] = entry
+            self.changed()
+
+    def remove(self, steam_id):
+        with self.lock:
+            if self.entries.pop(steam_id, None) is not None:
+                self.changed()
+
+    def sync(self, steam_users):
+        '''
+            Rebuilds the roster from the whole friends list.
+        '''
+
+        entries = dict((entry['SteamID64'], entry) for entry in (self.entry(steam_user) for steam_user in steam_users))
+
+        with self.lock:
+            if entries == self.entries:
+                return
+
+            self.entries = entries
+            self.changed()
+
+    def view(self, kind, ids=False):
+        with self.lock:
+            key = (kind, ids)
+
+            if key not in self.views:
+                entries = [
+                    self.entries[steam_id] for steam_id in sorted(self.entries.keys())
+                    if (self.entries[steam_id]['relationship'] == FRIEND) == (kind == FRIENDS)
+                ]
+
+                if kind == FRIENDS:
+                    entries = [
+                        dict((field, value) for field, value in entry.items() if field != 'relationship')
+                        for entry in entries
+                    ]
+
+                self.views[key] = RosterView(entries, ids=ids)
+
+            return self.views[key]
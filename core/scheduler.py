@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+import random
+
+import config
+
+from core import accounts
+
+# Accounts are ranked, best first, by:
+#
+# 1. idle: nothing queued or running for it and an empty cart. Busy accounts
+#    are never picked, the order would end up in the cart of another order
+#    and be gifted with it.
+# 2. funding: the cached wallet balance covers the cart subtotal plus the
+#    order subtotal (checkout_cart pays with steamaccount), then accounts
+#    never seen yet, then accounts that would fall back to bitcoin.
+# 3. recent checkout failures.
+# 4. queue depth, then the largest balance left after the order.
+
+FUNDED = 0
+UNKNOWN = 1
+UNDERFUNDED = 2
+
+
+def get_network_ids():
+    return [int(network_id) for network_id in getattr(config, 'EDGE_ACCOUNTS', config.ENABLED_ACCOUNTS)]
+
+
+def recent_failures(state, now):
+    failure_window = getattr(config, 'SCHEDULER_FAILURE_WINDOW', 600)
+
+    if now - state.get('failed_at', 0) > failure_window:
+        return 0
+
+    return int(state.get('failures', 0))
+
+
+def funding(state, subtotal):
+    if 'balance' not in state:
+        return UNKNOWN, 0
+
+    headroom = state['balance'] - state.get('cart_subtotal', 0) - (subtotal or 0)
+
+    return (FUNDED if headroom >= 0 else UNDERFUNDED), headroom
+
+
+def is_busy(state):
+    return bool(
+        state['leased'] or
+        state.get('reserved') or
+        state['queue_depth'] > 0 or
+        state.get('cart_count', 0) > 0
+    )
+
+
+def rank(state, subtotal, now):
+    funding_tier, headroom = funding(state, subtotal)
+
+    return (
+        is_busy(state),
+        funding_tier,
+        recent_failures(state, now),
+        state['queue_depth'],
+        -headroom,
+        random.random()
+    )
+
+
+def rank_accounts(subtotal=None, network_ids=None, exclude=()):
+    '''
+        subtotal: order subtotal in cents, when known.
+
+        Returns [(network_id, state), ...] best account first, leaving out
+        accounts in a purchase limit cooldown.
+    '''
+
+    network_ids = [network_id for network_id in network_ids or get_network_ids() if network_id not in exclude]
+    states = accounts.get_account_states(network_ids)
+
+    now = time.time()
+
+    return sorted(
+        [(network_id, state) for network_id, state in states.items() if not state['cooldown']],
+        key=lambda (network_id, state): rank(state, subtotal, now)
+    )
+
+
+def pick_account(subtotal=None, network_ids=None, exclude=()):
+    '''
+        Returns the best idle account, or None when every account is busy
+        or cooling down. Only a read, see reserve_account to place an order.
+    '''
+
+    ranked = rank_accounts(subtotal=subtotal, network_ids=network_ids, exclude=exclude)
+    idle = [network_id for network_id, state in ranked if not is_busy(state)]
+
+    if not len(idle):
+        return None
+
+    return idle[0]
+
+
+def reserve_account(subtotal=None, network_ids=None, exclude=()):
+    '''
+        Like pick_account, but reserves the account it returns (see
+        accounts.reserve). The caller releases the reservation once the
+        order is enqueued or given up.
+    '''
+
+    ranked = rank_accounts(subtotal=subtotal, network_ids=network_ids, exclude=exclude)
+
+    for network_id, state in ranked:
+        if is_busy(state) or not accounts.reserve(network_id):
+            continue
+
+        # Another request may have enqueued an order for it and released its
+        # reservation between the ranking and ours.
+
+        if is_busy(dict(accounts.get_account_states([network_id])[network_id], reserved=False)):
+            accounts.release_reservation(network_id)
+
+            continue
+
+        return network_id
+
+    return None
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import gevent.pool
+
+from gevent.pywsgi import WSGIServer
+
+import config
+
+
+def build_server(application, host=None, port=None, pool_size=None, backlog=None, **kwargs):
+    '''
+        gevent WSGI server handling each request in its own greenlet, up to
+        HTTP_POOL_SIZE at once. Connections past that wait in the listen
+        backlog (HTTP_BACKLOG) instead of spawning without limit.
+
+        Requests only overlap if gevent.monkey.patch_all() ran before
+        anything imported socket, ssl, threading or time, see run_app.py.
+    '''
+
+    pool = gevent.pool.Pool(pool_size or getattr(config, 'HTTP_POOL_SIZE', 256))
+
+    return WSGIServer(
+        (host or config.HOST, port or config.PORT),
+        application,
+        spawn=pool,
+        backlog=backlog or getattr(config, 'HTTP_BACKLOG', 1024),
+        **kwargs
+    )
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import os
+import json
+import pickle
+
+import redis
+import requests
+
+import config
+
+from core import shared
+from core import transport
+
+COOKIE_FIELDS = ['name', 'value', 'domain', 'path', 'secure', 'expires']
+
+
+def dump_cookies(cookie_jar):
+    return [[getattr(cookie, field) for field in COOKIE_FIELDS] for cookie in cookie_jar]
+
+
+def load_cookies(cookie_jar, cookies):
+    for name, value, domain, path, secure, expires in cookies:
+        cookie_jar.set(name, value, domain=domain, path=path, secure=secure, expires=expires)
+
+
+def build_session(cookies=None):
+    session = transport.configure_session(requests.Session())
+
+    if cookies:
+        load_cookies(session.cookies, cookies)
+
+    return session
+
+
+class FileSessionStore(object):
+    '''
+        Persists the cookie jar of a WebAccount session as compact JSON in
+        data/<network_id>.cookies. Writes go to a temporary file that is
+        renamed over the previous one, so readers never see a partial file.
+
+        The file modification time is used as the snapshot version.
+    '''
+
+    def __init__(self, network_id):
+        self.path = os.path.join('data', '{}.cookies'.format(network_id))
+        self.legacy_path = os.path.join('data', '{}.pickle'.format(network_id))
+
+        self.version = None
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.legacy_path)
+
+    def current_version(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def is_stale(self):
+        return self.current_version() != self.version
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self.load_legacy()
+
+        self.version = self.current_version()
+
+        f = open(self.path, 'r')
+        raw = f.read()
+        f.close()
+
+        try:
+            cookies = json.loads(raw)
+        except ValueError:
+            return None
+
+        return build_session(cookies)
+
+    def load_legacy(self):
+        if not os.path.exists(self.legacy_path):
+            return None
+
+        f = open(self.legacy_path, 'rb')
+        session = pickle.load(f)
+        f.close()
+
+        session = build_session(dump_cookies(session.cookies))
+        self.save(session)
+
+        return session
+
+    def save(self, session):
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+
+        f = open(tmp_path, 'w')
+        f.write(json.dumps(dump_cookies(session.cookies), separators=(',', ':')))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        os.rename(tmp_path, self.path)
+
+        self.version = self.current_version()
+
+        return True
+
+
+class RedisSessionStore(object):
+    '''
+        Shares the cookie jar of a WebAccount session between worker nodes.
+
+        Every snapshot carries a version, saves only go through when nobody
+        else saved since this store last loaded (compare-and-set), and
+        cookies are cached in-process so a load costs a single version read
+        while the snapshot does not change.
+    '''
+
+    cache = {}
+
+    def __init__(self, network_id):
+        self.key = shared.key('session', network_id)
+        self.version = None
+
+    def exists(self):
+        return bool(shared.get_redis().exists(self.key))
+
+    def current_version(self):
+        return int(shared.get_redis().hget(self.key, 'version') or 0)
+
+    def is_stale(self):
+        return self.current_version() != (self.version or 0)
+
+    def load(self):
+        version = self.current_version()
+        cached = self.cache.get(self.key)
+
+        if cached and cached[0] == version:
+            cookies = cached[1]
+        else:
+            version, raw = shared.get_redis().hmget(self.key, 'version', 'cookies')
+
+            if raw is None:
+                return None
+
+            version = int(version or 0)
+            cookies = json.loads(raw)
+
+            self.cache[self.key] = (version, cookies)
+
+        self.version = version
+
+        return build_session(cookies)
+
+    def save(self, session):
+        cookies = dump_cookies(session.cookies)
+        expected_version = self.version or 0
+
+        with shared.get_redis().pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+
+                if int(pipe.hget(self.key, 'version') or 0) != expected_version:
+                    pipe.unwatch()
+
+                    return False
+
+                pipe.multi()
+                pipe.hmset(self.key, {
+                    'version': expected_version + 1,
+                    'cookies': json.dumps(cookies, separators=(',', ':'))
+                })
+                pipe.execute()
+            except redis.WatchError:
+                return False
+
+        self.version = expected_version + 1
+        self.cache[self.key] = (self.version, cookies)
+
+        return True
+
+
+SESSION_STORES = {
+    'file': FileSessionStore,
+    'redis': RedisSessionStore
+}
+
+
+def get_session_store(network_id):
+    return SESSION_STORES[getattr(config, 'SESSION_BACKEND', 'file')](network_id)
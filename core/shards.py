@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+import hashlib
+
+import gevent
+import gevent.pool
+import requests
+
+import config
+
+from core import shared
+from core import steambot
+
+log = steambot.log
+
+SHARDS_KEY = shared.key('shards')
+SHARD_URLS_KEY = shared.key('shard_urls')
+
+FORWARDED_HEADER = 'X-Shard-Forwarded'
+
+# SteamBot accounts can be spread over several run_app.py processes
+# (shards). Every shard sets SHARD_ID and SHARD_URL, heartbeats into Redis
+# and owns the accounts rendezvous hashing gives it over the live shards, so
+# when a shard stops heartbeating its accounts move to the others and come
+# back once it heartbeats again.
+#
+# Without SHARD_ID the process owns every account.
+
+
+def get_shard_id():
+    '''
+        SHARD_ID as a string, the type shard ids are read back from Redis
+        with, so comparisons hold whatever type it was configured with.
+    '''
+
+    shard_id = getattr(config, 'SHARD_ID', None)
+
+    if shard_id is None:
+        return None
+
+    return str(shard_id)
+
+
+def is_sharded():
+    return get_shard_id() is not None
+
+
+def heartbeat(shard_id, url):
+    pipe = shared.get_redis().pipeline()
+    pipe.zadd(SHARDS_KEY, {shard_id: time.time()})
+    pipe.hset(SHARD_URLS_KEY, shard_id, url)
+    pipe.execute()
+
+
+def leave(shard_id):
+    pipe = shared.get_redis().pipeline()
+    pipe.zrem(SHARDS_KEY, shard_id)
+    pipe.hdel(SHARD_URLS_KEY, shard_id)
+    pipe.execute()
+
+
+def live_shards():
+    '''
+        Returns {shard_id: url} for every shard that heartbeated within
+        SHARD_TTL seconds.
+    '''
+
+    client = shared.get_redis()
+    shard_ids = client.zrangebyscore(SHARDS_KEY, time.time() - getattr(config, 'SHARD_TTL', 15), '+inf')
+
+    if not len(shard_ids):
+        return {}
+
+    return dict(zip(shard_ids, client.hmget(SHARD_URLS_KEY, shard_ids)))
+
+
+def owner(network_id, shard_ids):
+    '''
+        Rendezvous hashing: the shard with the highest hash for the
+        network_id owns it, so a shard leaving only moves its own accounts.
+    '''
+
+    if not len(shard_ids):
+        return None
+
+    return max(shard_ids, key=lambda shard_id: hashlib.md5('{0}:{1}'.format(shard_id, network_id)).hexdigest())
+
+
+class ShardRouter(object):
+    '''
+        Finds the shard that owns a network_id, from a view of the live
+        shards refreshed every SHARD_ROUTE_CACHE seconds, and forwards
+        requests to it.
+    '''
+
+    def __init__(self):
+        self.shards = {}
+        self.refreshed_at = 0
+
+        self.session = requests.Session()
+
+    def get_shards(self):
+        if time.time() - self.refreshed_at > getattr(config, 'SHARD_ROUTE_CACHE', 1):
+            self.shards = live_shards()
+            self.refreshed_at = time.time()
+
+        return self.shards
+
+    def owner(self, network_id):
+        '''
+            Returns (shard_id, url) of the shard owning network_id, or
+            (None, None) when no shard is alive.
+        '''
+
+        shards = self.get_shards()
+        shard_id = owner(network_id, shards.keys())
+
+        return shard_id, shards.get(shard_id)
+
+    def forward(self, url, full_path, headers):
+        return self.session.get(
+            url.rstrip('/') + full_path,
+            headers=dict(headers, **{FORWARDED_HEADER: get_shard_id()}),
+            allow_redirects=False,
+            timeout=getattr(config, 'SHARD_FORWARD_TIMEOUT', 30)
+        )
+
+
+class ShardKeeper(object):
+    '''
+        Heartbeats for this shard and starts or stops the SteamBots whose
+        ownership changed as shards come and go.
+    '''
+
+    def __init__(self, workers, init_worker, size=None):
+        self.workers = workers
+        self.init_worker = init_worker
+
+        self.shard_id = get_shard_id()
+        self.url = config.SHARD_URL
+
+        self.pool = gevent.pool.Pool(size or getattr(config, 'STEAMBOT_STARTUP_CONCURRENCY', 8))
+        self.running = set()
+
+    def start(self):
+        return [gevent.spawn(self.heartbeat_forever), gevent.spawn(self.reconcile_forever)]
+
+    def heartbeat_forever(self):
+        while True:
+            try:
+                heartbeat(self.shard_id, self.url)
+            except Exception, e:
+                log.error(u'Shard {0} failed to heartbeat: {1}'.format(self.shard_id, e))
+
+            gevent.sleep(getattr(config, 'SHARD_HEARTBEAT_INTERVAL', 5))
+
+    def reconcile_forever(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception, e:
+                log.error(u'Shard {0} failed to reconcile its accounts: {1}'.format(self.shard_id, e))
+
+            gevent.sleep(getattr(config, 'SHARD_HEARTBEAT_INTERVAL', 5))
+
+    def reconcile(self):
+        shard_ids = live_shards().keys()
+
+        if self.shard_id not in shard_ids:
+            # Not heartbeating, the other shards already took over.
+
+            shard_ids = []
+
+        owned = set(network_id for network_id in self.workers.keys() if owner(network_id, shard_ids) == self.shard_id)
+
+        for network_id in self.running - owned:
+            log.info(u'Shard {0} hands network_id {1} over'.format(self.shard_id, network_id))
+
+            self.running.discard(network_id)
+            self.workers[network_id].close()
+
+        for network_id in owned - self.running:
+            log.info(u'Shard {0} takes network_id {1}'.format(self.shard_id, network_id))
+
+            self.running.add(network_id)
+            self.pool.spawn(self.init_worker, network_id)
+
+    def stop(self):
+        leave(self.shard_id)
+
+        for network_id in self.running:
+            self.workers[network_id].close()
+
+        self.running = set()
+
+
+ROUTER = ShardRouter()
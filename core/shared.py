@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import redis
+
+import config
+
+KEY_PREFIX = 'steamcommerce'
+
+client = None
+
+
+def get_redis():
+    '''
+        Redis connection shared by everything that needs state across
+        workers. Defaults to the Celery broker.
+    '''
+
+    global client
+
+    if client is None:
+        client = redis.StrictRedis.from_url(getattr(config, 'SHARED_REDIS_URL', config.CELERY_BROKER_URL))
+
+    return client
+
+
+def key(*parts):
+    return ':'.join([KEY_PREFIX] + [str(part) for part in parts])
@@ -6,15 +6,26 @@ import json
 import time
 import base64
 
+import gevent
+
 import steam
 import steam.guard
+import steam.enums
 import steam.enums.emsg
 
 import config
+from core import cache
 from core import logger
+from core import roster
+from core import polling
 
 log = logger.Logger('steam.bot', 'steam.bot.log').get_logger()
 
+STATE_PENDING = 'pending'
+STATE_CONNECTING = 'connecting'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+
 
 def get_data_from_file(path):
     f = open(os.path.join(os.getcwd(), path), 'r')
@@ -40,12 +51,35 @@ class SteamBot(object):
         self.password = password
         self.logged_in = False
 
+        self.state = STATE_PENDING
+        self.state_error = None
+
         self.shared_secret = shared_secret
 
-        self.friend_add_results = {}
-        self.last_messages_received = {}
+        self.friend_add_results = cache.TTLCache(
+            maxsize=getattr(config, 'FRIEND_ADD_RESULTS_MAXSIZE', 10000),
+            ttl=getattr(config, 'FRIEND_ADD_RESULTS_TTL', 24 * 60 * 60)
+        )
+
+        # Entries older than the auto reply interval make no difference to
+        # client_incoming_message, so that is their time to live.
+
+        self.last_messages_received = cache.TTLCache(
+            maxsize=getattr(config, 'LAST_MESSAGES_MAXSIZE', 10000),
+            ttl=2 * 60 * 60
+        )
+
+        self.roster = roster.FriendRoster()
+        self.events_bound = False
+        self.reconnecting = False
 
     def init(self):
+        if not self.events_bound:
+            self.bind_events()
+
+        self.start()
+
+    def bind_events(self):
         self.steamclient.on('logged_on', self.client_logged_on)
         self.steamclient.on('connected', self.client_connected)
         self.steamclient.on('disconnected', self.client_disconnected)
@@ -55,26 +89,77 @@ class SteamBot(object):
             self.client_incoming_message
         )
 
+        self.steamclient.on(
+            steam.enums.emsg.EMsg.ClientFriendsList,
+            self.client_friends_list
+        )
+
+        self.steamclient.on(
+            steam.enums.emsg.EMsg.ClientPersonaState,
+            self.client_persona_state
+        )
+
+        self.steamclient.friends.on('ready', self.client_friends_ready)
+
         self.steamclient.friends.on('friend_new', self.client_friend_new)
         self.steamclient.friends.on('friend_invite', self.client_friend_invite)
         self.steamclient.friends.on('friend_removed', self.client_friend_removed)
         self.steamclient.friends.on('friend_add_result', self.client_friend_add_result)
 
-        self.login()
-        self.connect()
+        self.events_bound = True
+
+    def start(self, retries=None):
+        '''
+            Logs in, retrying with a backoff, and keeps the readiness state
+            up to date so requests for this account can be turned away
+            while it is not ready.
+        '''
+
+        retries = getattr(config, 'STEAMBOT_LOGIN_RETRIES', 3) if retries is None else retries
+
+        for attempt in range(retries + 1):
+            self.state = STATE_CONNECTING
+
+            try:
+                result = self.login()
+            except Exception, e:
+                result = e
+
+            if result == steam.enums.EResult.OK:
+                self.connect()
+
+                return True
+
+            log.error(u'Login for {0} failed with {1} (attempt {2})'.format(self.account_name, repr(result), attempt + 1))
+
+            self.state = STATE_FAILED
+            self.state_error = repr(result)
+
+            if attempt < retries:
+                gevent.sleep(polling.backoff(attempt, base_delay=5, max_delay=60))
+
+        return False
+
+    def is_ready(self):
+        return self.state == STATE_READY
 
     def login(self):
         log.info('Logging into account {0}'.format(self.account_name))
 
         if not self.shared_secret:
-            self.steamclient.login(self.account_name, self.password)
+            result = self.steamclient.login(self.account_name, self.password)
         else:
             twofactor_code = self.generate_twofactor_code(self.shared_secret)
             log.info('Received 2FA code {0}'.format(twofactor_code))
 
-            self.steamclient.login(self.account_name, self.password, two_factor_code=twofactor_code)
+            result = self.steamclient.login(self.account_name, self.password, two_factor_code=twofactor_code)
 
-        self.logged_in = True
+        if result == steam.enums.EResult.OK:
+            self.logged_in = True
+            self.state = STATE_READY
+            self.state_error = None
+
+        return result
 
     def logout(self):
         log.info(u'Logging out from account {}'.format(self.account_name))
@@ -90,6 +175,48 @@ class SteamBot(object):
 
         self.steamclient.connect()
 
+    def reconnect(self):
+        '''
+            Logs on again after the connection to the CM servers dropped,
+            with the login key Steam handed out when there is one (which
+            connects as well), otherwise through start() with the
+            credentials. The bot is marked failed if both fail.
+        '''
+
+        self.state = STATE_CONNECTING
+
+        try:
+            result = None
+
+            if self.steamclient.relogin_available:
+                try:
+                    result = self.steamclient.relogin()
+                except Exception, e:
+                    result = e
+
+            if result == steam.enums.EResult.OK:
+                log.info(u'Logged on again as {}'.format(self.account_name))
+
+                self.state = STATE_READY
+                self.state_error = None
+
+                return True
+
+            if result is not None:
+                log.error(u'Relogin for {0} failed with {1}'.format(self.account_name, repr(result)))
+
+            if self.start():
+                return True
+
+            log.error(u'SteamBot for account {} could not log on again'.format(self.account_name))
+
+            self.logged_in = False
+            self.state = STATE_FAILED
+
+            return False
+        finally:
+            self.reconnecting = False
+
     def close(self):
         log.info(
             u'SteamBot for account {0} is shutting down'.format(
@@ -99,6 +226,8 @@ class SteamBot(object):
 
         self.logout()
 
+        self.state = STATE_PENDING
+
     def message_client(self, steamid, message):
         return steam.client.user.SteamUser(steamid, self.steamclient).send_message(message)
 
@@ -127,12 +256,21 @@ class SteamBot(object):
     def client_disconnected(self):
         log.info(u'Disconnected from Steam CM servers')
 
-        if self.logged_in:
-            self.connect()  # Attempt re-connection
+        # Reconnecting alone leaves the bot connected but logged off, it has
+        # to log on again. Connections dropped while that is in progress are
+        # left to it.
+
+        if self.logged_in and not self.reconnecting:
+            self.state = STATE_CONNECTING
+            self.reconnecting = True
+
+            gevent.spawn(self.reconnect)
 
     def client_logged_on(self):
         log.info(u'Logged on as {}'.format(self.account_name))
 
+        self.state = STATE_READY
+
     def client_incoming_message(self, proto_msg):
         if proto_msg.body.chat_entry_type != 1:
             # Ignore this EChatEntryType (Typing, InviteGame, etc...)
@@ -151,30 +289,46 @@ class SteamBot(object):
 
         log.info(u'{0}: {1}'.format(from_steam_user.name, message.decode('utf-8')))
 
+    def client_friends_ready(self):
+        log.info(u'Friends list for {} is loaded'.format(self.account_name))
+
+        self.roster.sync(self.steamclient.friends)
+
+    def client_friends_list(self, proto_msg):
+        # The friends list handler of the client already ran, so invitations
+        # sent by this account (which get no event of their own) are there.
+
+        for friend in proto_msg.body.friends:
+            if friend.ulfriendid in self.steamclient.friends:
+                self.roster.update(self.steamclient.friends[friend.ulfriendid])
+            else:
+                self.roster.remove(friend.ulfriendid)
+
+    def client_persona_state(self, proto_msg):
+        # Names and avatars of friends come with persona states
+
+        for friend in proto_msg.body.friends:
+            if friend.friendid in self.roster.entries and friend.friendid in self.steamclient.friends:
+                self.roster.update(self.steamclient.friends[friend.friendid])
+
     def client_friend_new(self, steam_user):
         log.info(u'Accepted a friend invite from {}'.format(steam_user))
 
-        try:
-            del self.friend_add_results[steam_user.steam_id.as_64]
-        except:
-            pass
+        self.roster.update(steam_user)
+        self.friend_add_results.pop(steam_user.steam_id.as_64)
 
     def client_friend_removed(self, steam_user):
         log.info(u'{} is no longer in friends list'.format(steam_user))
 
-        try:
-            del self.friend_add_results[steam_user.steam_id.as_64]
-        except:
-            pass
+        self.roster.remove(steam_user.steam_id.as_64)
 
-        try:
-            del self.friend_add_results['0']
-        except:
-            pass
+        self.friend_add_results.pop(steam_user.steam_id.as_64)
+        self.friend_add_results.pop('0')
 
     def client_friend_invite(self, steam_user):
         log.info(u'Received a friend invite from {}'.format(steam_user))
 
+        self.roster.update(steam_user)
         self.add_friend(steam_user.steam_id.as_64)
 
     def client_friend_add_result(self, result, steam_id):
@@ -182,6 +336,17 @@ class SteamBot(object):
 
         self.friend_add_results[steam_id.as_64] = result.value
 
+    def get_state_stats(self):
+        return {
+            'state': self.state,
+            'friend_add_results': self.friend_add_results.stats(),
+            'last_messages_received': self.last_messages_received.stats(),
+            'roster': {
+                'size': len(self.roster.entries),
+                'version': self.roster.version
+            }
+        }
+
     def run_forever(self):
         try:
             self.steamclient.run_forever()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import time
+
+import config
+
+from steam.enums import EResult
+
+from core import shared
+
+PENDING_RESULTS = (EResult.Pending,)
+
+
+def is_terminal(result):
+    return result not in PENDING_RESULTS
+
+
+def save_transaction_status(network_id, transid, result, attempts):
+    key = shared.key('transaction', transid)
+    client = shared.get_redis()
+
+    client.hmset(key, {
+        'network_id': network_id,
+        'result': int(result),
+        'attempts': attempts,
+        'finished': int(is_terminal(result)),
+        'updated_at': time.time()
+    })
+
+    client.expire(key, getattr(config, 'TRANSACTION_STATUS_TTL', 7 * 24 * 60 * 60))
+
+
+def get_transaction_status(transid):
+    status = shared.get_redis().hgetall(shared.key('transaction', transid))
+
+    if not status:
+        return None
+
+    return {
+        'network_id': status.get('network_id'),
+        'result': int(status.get('result')),
+        'attempts': int(status.get('attempts')),
+        'finished': bool(int(status.get('finished'))),
+        'updated_at': float(status.get('updated_at'))
+    }
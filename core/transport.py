@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding:Utf-8 -*-
+
+import threading
+
+from urlparse import urlparse
+
+import requests.adapters
+
+import config
+
+STORE_URL = getattr(config, 'STEAM_STORE_URL', 'https://store.steampowered.com').rstrip('/')
+STORE_HOST = urlparse(STORE_URL).hostname
+
+DEFAULT_HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive'
+}
+
+
+def store_url(path=''):
+    return STORE_URL + path
+
+
+class SteamAdapter(requests.adapters.HTTPAdapter):
+    '''
+        Keep-alive adapter shared by every Steam session of the process.
+
+        Keeps up to pool_maxsize connections open per host, applies the
+        configured (connect, read) timeout to requests that do not set one
+        and never retries on its own, purchase calls are not idempotent.
+    '''
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+
+        super(SteamAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super(SteamAdapter, self).send(request, **kwargs)
+
+    def stats(self):
+        '''
+            Returns {host: {'connections': n, 'requests': n, 'reused': n}}
+            where connections counts the sockets opened for that host.
+        '''
+
+        stats = {}
+
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+
+            if pool is None:
+                continue
+
+            host_stats = stats.setdefault(pool.host, {'connections': 0, 'requests': 0, 'reused': 0})
+            host_stats['connections'] += pool.num_connections
+            host_stats['requests'] += pool.num_requests
+            host_stats['reused'] += max(pool.num_requests - pool.num_connections, 0)
+
+        return stats
+
+
+adapter = None
+adapter_lock = threading.Lock()
+
+
+def get_adapter():
+    global adapter
+
+    with adapter_lock:
+        if adapter is None:
+            adapter = SteamAdapter(
+                timeout=(
+                    getattr(config, 'STEAM_CONNECT_TIMEOUT', 3.05),
+                    getattr(config, 'STEAM_READ_TIMEOUT', 20)
+                ),
+                pool_connections=getattr(config, 'STEAM_POOL_HOSTS', 4),
+                pool_maxsize=getattr(config, 'STEAM_POOL_MAXSIZE', getattr(config, 'ACCOUNT_ENGINE_SIZE', 16))
+            )
+
+    return adapter
+
+
+def configure_session(session):
+    '''
+        Mounts the shared adapter on a requests session. Sessions built
+        from a stored cookie jar or returned by a fresh login both go
+        through here, so the transport survives a save/restore round trip.
+    '''
+
+    shared_adapter = get_adapter()
+
+    session.mount('https://', shared_adapter)
+    session.mount('http://', shared_adapter)
+    session.headers.update(DEFAULT_HEADERS)
+
+    return session
+
+
+def get_stats():
+    stats = get_adapter().stats()
+
+    connections = sum(host_stats['connections'] for host_stats in stats.values())
+    requests_sent = sum(host_stats['requests'] for host_stats in stats.values())
+
+    return {
+        'hosts': stats,
+        'connections': connections,
+        'requests': requests_sent,
+        'reuse_ratio': round(1 - float(connections) / requests_sent, 4) if requests_sent else 0
+    }
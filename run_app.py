@@ -1,30 +1,39 @@
 #!/usr/bin/env python
 # -*- coding:Utf-8 -*-
 
+# Patch before anything imports socket, ssl, threading or time. Otherwise
+# Redis, Celery and requests calls block the hub and the server handles one
+# request at a time.
+
+from gevent import monkey
+monkey.patch_all()
+
 import config
 
 from app import app
 
+from core import server
+from core import shards
 from core import steambot
 from workers import WORKERS
-from gevent.wsgi import WSGIServer
+from workers import start_workers
 
-try:
-    for network_id in WORKERS.keys():
-        WORKERS[network_id].init()
-except Exception, e:
-    steambot.log.error(e)
+# Accounts log in in the background, isteamuser answers 503 for the ones
+# that are not ready yet.
 
-    raise SystemExit
+keeper = start_workers()
 
 steambot.log.info('Starting HTTP Server on {0}:{1}'.format(config.HOST, config.PORT))
 
-http_server = WSGIServer((config.HOST, config.PORT), app)
+http_server = server.build_server(app)
 
 try:
     http_server.serve_forever()
 except KeyboardInterrupt:
     steambot.log.info(u'Shutting down HTTP Server')
 
-for network_id in WORKERS.keys():
-    WORKERS[network_id].close()
+if shards.is_sharded():
+    keeper.stop()
+else:
+    for network_id in WORKERS.keys():
+        WORKERS[network_id].close()
@@ -1,12 +1,269 @@
 #!/usr/bin/env python
 # -*- coding:Utf-8 -*-
 
+import json
+import time
+
+import redis
 import config
+import celery.states
 
 from celery import Celery
+from celery import Task
+from celery.utils import uuid
+from celery.exceptions import Retry
+
+from core import shared
+from core import metrics
+from core import accounts
 
 app = Celery(
     'edge.tasks',
     backend=config.CELERY_RESULT_BACKEND,
     broker=config.CELERY_BROKER_URL
 )
+
+# Custom state of tasks that report how far they got, the result holds the
+# current stage.
+
+PROGRESS = 'PROGRESS'
+
+
+class InstrumentedTask(Task):
+    '''
+        Base for edge tasks that records how long they waited in the queue
+        and how long they ran, and publishes their state changes on a Redis
+        channel per task id (see task_events_channel).
+
+        The enqueue time is kept in Redis under the task id until the task
+        runs. Retries for a busy account keep the original enqueue time, a
+        retry with a countdown only starts waiting once the countdown ends.
+    '''
+
+    abstract = True
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        task_id = options.setdefault('task_id', uuid())
+
+        try:
+            shared.get_redis().set(
+                shared.key('enqueued', task_id),
+                time.time() + (options.get('countdown') or 0),
+                ex=getattr(config, 'TASK_ENQUEUED_TTL', 3600),
+                nx=True
+            )
+        except redis.RedisError:
+            pass
+
+        return super(InstrumentedTask, self).apply_async(args=args, kwargs=kwargs, **options)
+
+    def __call__(self, *args, **kwargs):
+        self.observe_queue_wait()
+        self.publish_state(self.request.id, celery.states.STARTED)
+
+        started_at = time.time()
+        outcome = 'failure'
+
+        try:
+            result = super(InstrumentedTask, self).__call__(*args, **kwargs)
+            outcome = 'success'
+
+            return result
+        except Retry:
+            outcome = 'retry'
+
+            raise
+        finally:
+            metrics.observe('task_duration_seconds', time.time() - started_at, task=self.name, result=outcome)
+
+    def observe_queue_wait(self):
+        if not self.request.id:
+            return
+
+        try:
+            pipe = shared.get_redis().pipeline()
+            pipe.get(shared.key('enqueued', self.request.id))
+            pipe.delete(shared.key('enqueued', self.request.id))
+            enqueued_at = pipe.execute()[0]
+        except redis.RedisError:
+            return
+
+        if enqueued_at is not None:
+            metrics.observe('task_queue_wait_seconds', max(time.time() - float(enqueued_at), 0), task=self.name)
+
+    def publish_state(self, task_id, state, result=None):
+        if not task_id:
+            return
+
+        entry = task_entry(state, result)
+        entry['task_id'] = task_id
+
+        try:
+            message = json.dumps(entry)
+        except (TypeError, ValueError):
+            entry.pop('task_result', None)
+            message = json.dumps(entry)
+
+        try:
+            shared.get_redis().publish(task_events_channel(task_id), message)
+        except redis.RedisError:
+            pass
+
+    def report_progress(self, stage, **info):
+        '''
+            Stores and publishes a PROGRESS state for the running task.
+        '''
+
+        meta = dict(info, stage=stage)
+
+        if self.request.id:
+            self.update_state(state=PROGRESS, meta=meta)
+
+        self.publish_state(self.request.id, PROGRESS, meta)
+
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        self.publish_state(task_id, celery.states.RETRY)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        self.publish_state(task_id, status, retval)
+
+
+class AccountTask(InstrumentedTask):
+    '''
+        Base for tasks whose first argument is a network_id.
+
+        Tasks for the same account run one at a time: a task that finds the
+        account leased by another one is retried after a short countdown,
+        while tasks for other accounts keep running in parallel. Pending
+        tasks are counted per account by task id (see
+        accounts.add_queued_task), added before they are published.
+    '''
+
+    abstract = True
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        task_id = options.setdefault('task_id', uuid())
+
+        accounts.add_queued_task(args[0], task_id, time.time() + (options.get('countdown') or 0))
+
+        try:
+            return super(AccountTask, self).apply_async(args=args, kwargs=kwargs, **options)
+        except Exception:
+            accounts.remove_queued_task(args[0], task_id)
+
+            raise
+
+    def __call__(self, *args, **kwargs):
+        lease = accounts.AccountLease(args[0])
+
+        if not lease.acquire():
+            metrics.incr('task_lease_retries_total', task=self.name)
+
+            raise self.retry(
+                countdown=getattr(config, 'ACCOUNT_LEASE_RETRY_DELAY', 2),
+                max_retries=None
+            )
+
+        lease.keep_alive()
+
+        # Ages from when it started, a long wait in the queue does not get
+        # the running task pruned.
+
+        accounts.add_queued_task(args[0], self.request.id)
+
+        try:
+            return super(AccountTask, self).__call__(*args, **kwargs)
+        finally:
+            lease.release()
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        super(AccountTask, self).after_return(status, retval, task_id, args, kwargs, einfo)
+
+        accounts.remove_queued_task(args[0], task_id)
+
+
+class AccountsTask(InstrumentedTask):
+    '''
+        Base for tasks whose first argument is {network_id: ..., ...} and
+        that work on several accounts at once. Pending tasks are counted
+        for every account like AccountTask does, so the scheduler sees them
+        as busy. Leasing the accounts is left to the task.
+    '''
+
+    abstract = True
+
+    def network_ids(self, args):
+        return accounts.parse_network_ids(args[0].keys()).values()
+
+    def apply_async(self, args=None, kwargs=None, **options):
+        task_id = options.setdefault('task_id', uuid())
+        due_at = time.time() + (options.get('countdown') or 0)
+
+        for network_id in self.network_ids(args):
+            accounts.add_queued_task(network_id, task_id, due_at)
+
+        try:
+            return super(AccountsTask, self).apply_async(args=args, kwargs=kwargs, **options)
+        except Exception:
+            self.remove_queued_task(task_id, args)
+
+            raise
+
+    def remove_queued_task(self, task_id, args):
+        for network_id in self.network_ids(args):
+            accounts.remove_queued_task(network_id, task_id)
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        super(AccountsTask, self).after_return(status, retval, task_id, args, kwargs, einfo)
+
+        self.remove_queued_task(task_id, args)
+
+
+def task_events_channel(task_id):
+    return shared.key('task_events', task_id)
+
+
+def task_entry(state, result=None):
+    '''
+        Compact view of a task state: the result once it succeeded, the
+        progress while it runs, the repr of the error once it failed.
+    '''
+
+    entry = {'task_status': state}
+
+    if state == celery.states.SUCCESS:
+        entry['task_result'] = result
+    elif state == PROGRESS:
+        entry['task_progress'] = result
+    elif state in celery.states.PROPAGATE_STATES:
+        entry['task_error'] = repr(result)
+
+    return entry
+
+
+def get_task_states(task_ids):
+    '''
+        Returns {task_id: (state, result)}. Result backends that can fetch
+        many keys at once (Redis, memcached) are read in one round trip.
+    '''
+
+    backend = app.backend
+
+    if not hasattr(backend, 'mget'):
+        results = dict((task_id, app.AsyncResult(task_id)) for task_id in task_ids)
+
+        return dict((task_id, (result.state, result.result)) for task_id, result in results.items())
+
+    values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    states = {}
+
+    for task_id, value in zip(task_ids, values):
+        if value is None:
+            states[task_id] = ('PENDING', None)
+
+            continue
+
+        meta = backend.decode_result(value)
+        states[task_id] = (meta['status'], meta['result'])
+
+    return states
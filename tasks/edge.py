@@ -1,51 +1,237 @@
 #!/usr/bin/env python
 # -*- coding:Utf-8 -*-
 
+import time
+
 from core import bot
+from core import enums
+from core import engine
+from core import accounts
+from core import polling
+from core import transactions
+from core import transport
+from core.pool import POOL
 from tasks import app
 
+from steam.enums import EResult
 
-@app.app.task(bind=True)
+
+@app.app.task(bind=True, base=app.AccountTask)
 def add_subids_to_cart(self, network_id, items):
-    edge_bot = bot.EdgeBot(network_id)
-    response = edge_bot.add_subids_to_cart(items)
+    with POOL.account(network_id) as web_account:
+        edge_bot = bot.EdgeBot(network_id, web_account=web_account)
+        response = edge_bot.add_subids_to_cart(items)
 
     return response
 
 
-@app.app.task(bind=True)
+@app.app.task(bind=True, base=app.AccountTask)
 def checkout_cart(self, network_id, giftee_account_id):
-    edge_bot = bot.EdgeBot(network_id)
-    response = edge_bot.checkout_cart(giftee_account_id)
+    retry_after = accounts.admission_delay(network_id, take=True)
+
+    if retry_after:
+        # Waits in countdowns of at most get_max_defer() seconds, a longer
+        # one would outlast the broker visibility_timeout.
+
+        raise self.retry(countdown=min(retry_after, accounts.get_max_defer()), max_retries=None)
+
+    with POOL.account(network_id) as web_account:
+        edge_bot = bot.EdgeBot(network_id, web_account=web_account)
+        response = edge_bot.checkout_cart(giftee_account_id)
+
+    accounts.record_checkout(network_id, isinstance(response, dict) and response.get('result') != EResult.Fail.value)
 
     return response
 
 
-@app.app.task(bind=True)
+@app.app.task(bind=True, base=app.AccountTask)
 def reset_shopping_cart(self, network_id):
-    edge_bot = bot.EdgeBot(network_id)
-
-    edge_bot.web_account.reset_shopping_cart_gid()
-    edge_bot.web_account.save_session_to_file()
+    with POOL.account(network_id) as web_account:
+        web_account.reset_shopping_cart_gid()
+        web_account.save_session()
 
     return {'success': True}
 
 
-@app.app.task(bind=True)
-def poll_transaction_status(self, network_id, transid):
-    edge_bot = bot.EdgeBot(network_id)
-    response = edge_bot.web_account.poll_transaction_status(transid, times=50, delay=1)
+@app.app.task(bind=True, base=app.InstrumentedTask)
+def poll_transaction_status(self, network_id, transid, times=50, delay=1, deadline=300, started_at=None):
+    '''
+        Checks the transaction status once and re-arms itself with a backoff
+        countdown while it is still pending, so no worker slot is held
+        between polls. Gives up after `times` polls or `deadline` seconds.
 
-    return response
+        Polls run without the account lease, so they only log in again when
+        the session is logged out and the lease is free to take.
+    '''
 
+    started_at = started_at or time.time()
 
-@app.app.task(bind=True)
+    with POOL.account(network_id) as web_account:
+        transaction_status = web_account.read_transaction_status(transid)
+
+        if transaction_status == enums.EWebAccountResult.NotLoggedIn:
+            lease = accounts.AccountLease(network_id)
+
+            if lease.acquire():
+                try:
+                    transaction_status = web_account.get_transaction_status(transid)
+                finally:
+                    lease.release()
+
+    attempts = self.request.retries + 1
+
+    if isinstance(transaction_status, enums.EWebAccountResult):
+        result = EResult.Pending
+    else:
+        result = EResult(transaction_status.get('success'))
+
+    countdown = polling.backoff(self.request.retries, base_delay=delay)
+
+    if not transactions.is_terminal(result) and attempts < times and time.time() - started_at + countdown < deadline:
+        raise self.retry(
+            kwargs={
+                'times': times,
+                'delay': delay,
+                'deadline': deadline,
+                'started_at': started_at
+            },
+            countdown=countdown,
+            max_retries=times
+        )
+
+    transactions.save_transaction_status(network_id, transid, result, attempts)
+
+    return result.value
+
+
+@app.app.task(bind=True, base=app.AccountTask)
 def get_external_link_from_transid(self, network_id, transid):
-    edge_bot = bot.EdgeBot(network_id)
-    response = edge_bot.web_account.get_external_link_from_transid(transid)
+    with POOL.account(network_id) as web_account:
+        response = web_account.get_external_link_from_transid(transid)
 
     # Give edge controller 60 seconds for payment to complete purchase
 
     poll_transaction_status.delay(network_id, transid)
 
     return response
+
+
+@app.app.task(bind=True, base=app.AccountTask)
+def purchase_order(self, network_id, items, giftee_account_id, partial=False):
+    '''
+        Adds the items to the cart, checks it out and, for bitcoin payments,
+        gets the external link, with one account lease and one pooled
+        account. Reports the 'cart', 'checkout' and 'link' stages as
+        PROGRESS states.
+
+        Unless `partial` is set, the cart is reset and left unpaid when any
+        item could not be added.
+
+        response:
+
+        {
+            'network_id': 1,
+            'cart': {add_subids_to_cart response},
+            'checkout': {checkout_cart response} or None,
+            'link': {get_external_link_from_transid response} or None
+        }
+    '''
+
+    retry_after = accounts.admission_delay(network_id, take=True)
+
+    if retry_after:
+        raise self.retry(countdown=min(retry_after, accounts.get_max_defer()), max_retries=None)
+
+    response = {
+        'network_id': network_id,
+        'cart': None,
+        'checkout': None,
+        'link': None
+    }
+
+    with POOL.account(network_id) as web_account:
+        edge_bot = bot.EdgeBot(network_id, web_account=web_account)
+
+        self.report_progress('cart', items=len(items))
+
+        response['cart'] = edge_bot.add_subids_to_cart(items)
+        added = len(response['cart']['items'])
+
+        if not added or (added < len(items) and not partial):
+            web_account.reset_shopping_cart_gid()
+            web_account.save_session()
+
+            return response
+
+        self.report_progress('checkout', items=added)
+
+        response['checkout'] = edge_bot.checkout_cart(giftee_account_id)
+
+        accounts.record_checkout(
+            network_id,
+            isinstance(response['checkout'], dict) and response['checkout'].get('result') != EResult.Fail.value
+        )
+
+        if not isinstance(response['checkout'], dict) or response['checkout'].get('payment_method') != 'bitcoin':
+            return response
+
+        transid = response['checkout']['transid']
+
+        self.report_progress('link', transid=transid)
+
+        response['link'] = web_account.get_external_link_from_transid(transid)
+
+    poll_transaction_status.delay(network_id, transid)
+
+    return response
+
+
+@app.app.task(bind=True, base=app.AccountsTask)
+def add_subids_to_carts(self, orders):
+    '''
+        orders: {network_id: items, ...}
+
+        Fills the carts of several accounts concurrently from one worker.
+        Accounts leased by another task are reported as busy, network_ids
+        that are not numbers as invalid.
+    '''
+
+    network_ids = accounts.parse_network_ids(orders.keys())
+
+    leases = {}
+    keys = []
+    calls = []
+
+    try:
+        for key, network_id in network_ids.items():
+            lease = accounts.AccountLease(network_id)
+
+            if lease.acquire():
+                lease.keep_alive()
+                leases[key] = lease
+                keys.append(key)
+                calls.append((network_id, 'add_subids_to_cart', (orders[key],), None))
+
+        results = engine.get_engine().run(calls)
+    finally:
+        for lease in leases.values():
+            lease.release()
+
+    response = dict((key, {'invalid': True}) for key in orders.keys() if key not in network_ids)
+    response.update((key, {'busy': True}) for key in network_ids.keys() if key not in leases)
+
+    for key, result in zip(keys, results):
+        if isinstance(result, enums.EWebAccountResult):
+            result = {'result': result.value}
+
+        response[key] = result
+
+    return response
+
+
+@app.app.task(bind=True)
+def get_account_pool_stats(self):
+    stats = POOL.stats()
+    stats['transport'] = transport.get_stats()
+
+    return stats
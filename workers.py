@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding:Utf-8 -*-
 
+import gevent
+import gevent.pool
+
 import config
+from core import shards
 from core import steambot
 
 WORKERS = {}
@@ -14,3 +18,34 @@ for network_id in config.ENABLED_ACCOUNTS:
         password=data.get('password'),
         shared_secret=data.get('shared_secret')
     )
+
+
+def init_worker(network_id):
+    try:
+        WORKERS[network_id].init()
+    except Exception, e:
+        steambot.log.error(u'SteamBot for network_id {0} failed to start: {1}'.format(network_id, e))
+
+        WORKERS[network_id].state = steambot.STATE_FAILED
+        WORKERS[network_id].state_error = repr(e)
+
+
+def start_workers(size=None):
+    '''
+        Logs every SteamBot in from a bounded pool of greenlets and returns
+        right away. Each bot reports its own readiness, so a slow or failing
+        account does not hold up the others or the HTTP server.
+
+        When SHARD_ID is set only the accounts owned by this shard are
+        logged in, and ownership is followed as shards come and go.
+    '''
+
+    if shards.is_sharded():
+        keeper = shards.ShardKeeper(WORKERS, init_worker, size=size)
+        keeper.start()
+
+        return keeper
+
+    pool = gevent.pool.Pool(size or getattr(config, 'STEAMBOT_STARTUP_CONCURRENCY', 8))
+
+    return gevent.spawn(pool.map, init_worker, WORKERS.keys())